@@ -19,10 +19,17 @@ import jinja2
 import os
 import time
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
 
 template_dir = os.path.join(os.path.dirname(__file__),'templates')
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), autoescape=True)
+# Keep compiled templates in memcache so a new instance can skip compiling the
+# blog's pages. Memcache may evict them at any time; they are then compiled
+# again on first use.
+jinja_env = jinja2.Environment(
+    loader = jinja2.FileSystemLoader(template_dir), autoescape=True,
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        memcache.Client(), prefix='jinja2/bytecode/'))
 
 
 class Entry(db.Model):
@@ -89,8 +96,17 @@ class PostHandler(Handler):
         date=data.get().created.date().strftime('%A, %B %d, %Y')
         self.render("postpermalink.html", title=title,article=article, date=date)
 
+# Answers /_ah/warmup by compiling the front page, new post and permalink
+# templates before the instance is sent any traffic.
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        for name in jinja_env.list_templates():
+            jinja_env.get_template(name)
+
+
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
     ('/newpost', NewPostHandler),
-    (r'/post/[0-9]+', PostHandler)
+    (r'/post/[0-9]+', PostHandler),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
@@ -19,8 +19,15 @@ import os
 import jinja2
 import codecs
 
+from google.appengine.api import memcache
+
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), autoescape=True)
+# The compiled form template is cached in memcache, which is not durable: if
+# it has been evicted, the template is compiled again.
+jinja_env = jinja2.Environment(
+    loader = jinja2.FileSystemLoader(template_dir), autoescape=True,
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        memcache.Client(), prefix='jinja2/bytecode/'))
 
 class Handler(webapp2.RequestHandler):
     def write(self, *a, **kw):
@@ -44,6 +51,14 @@ class MainPage(Handler):
         self.render("rotinput.html", coded=coded)
 
 
+# Compiles the form template when App Engine warms up a new instance.
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        for name in jinja_env.list_templates():
+            jinja_env.get_template(name)
+
+
 app = webapp2.WSGIApplication([
-    ('/', MainPage)
+    ('/', MainPage),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
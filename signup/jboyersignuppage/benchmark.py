@@ -0,0 +1,1346 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the blog application. They run the WSGI app from main.py
+# against the App Engine SDK's local datastore and memcache stubs, so the SDK
+# must be on the python path. Run from this directory:
+#
+#     python benchmark.py writes
+#
+# Each scenario prints the latency of the operations it measures. The routes
+# scenario drives every route of the application with concurrent clients:
+#
+#     python benchmark.py routes --posts 1000 --clients 16 --json run.json
+#
+# --json saves the results, and --baseline compares a run with saved ones.
+# Runs are seeded, so the same arguments make the same data.
+#
+
+import argparse
+import bisect
+import datetime
+import filecmp
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from google.appengine.api import apiproxy_rpc
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import testbed
+
+
+# Activate the local service stubs. This has to happen before the application
+# makes any API call. With latency (in milliseconds) every datastore call takes
+# at least that long to complete. With require_indexes, a query that needs an
+# index missing from index.yaml fails instead of running.
+def setup_stubs(latency=0, require_indexes=False):
+    root = os.path.dirname(__file__) or '.'
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(require_indexes=require_indexes,
+                               root_path=root)
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=root)
+    if latency:
+        stub = apiproxy_stub_map.apiproxy.GetStub('datastore_v3')
+        apiproxy_stub_map.apiproxy.ReplaceStub('datastore_v3',
+            LatencyStub(stub, latency / 1000.0))
+    return bed
+
+
+# RPC that completes its call straight away but does not report it finished
+# until the injected latency has passed since it was started. Calls that are
+# in flight together therefore overlap, as they would against the real
+# datastore, while calls made one after another add up.
+class DelayedRPC(apiproxy_rpc.RPC):
+    def __init__(self, latency, *args, **kwargs):
+        apiproxy_rpc.RPC.__init__(self, *args, **kwargs)
+        self.latency = latency
+
+    def _MakeCallImpl(self):
+        self.started = time.time()
+        apiproxy_rpc.RPC._MakeCallImpl(self)
+
+    def _WaitImpl(self):
+        remaining = self.started + self.latency - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+        return apiproxy_rpc.RPC._WaitImpl(self)
+
+
+# Wraps a service stub so every call made through it is delayed.
+class LatencyStub(object):
+    def __init__(self, stub, latency):
+        self.stub = stub
+        self.latency = latency
+
+    def CreateRPC(self):
+        return DelayedRPC(self.latency, stub=self.stub)
+
+    def MakeSyncCall(self, service, call, request, response):
+        start = time.time()
+        self.stub.MakeSyncCall(service, call, request, response)
+        remaining = start + self.latency - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def __getattr__(self, name):
+        return getattr(self.stub, name)
+
+
+# Return the cookie header for a logged in user, creating a session for them
+# the first time.
+def login_cookie(main, username, sids={}):
+    if username not in sids:
+        sids[username] = main.sessions.cookie_value(
+            main.sessions.create(username))
+    return ('Cookie', 'sid=%s' % sids[username])
+
+
+# Send a request through the application and return the response.
+def request(main, path, username=None, method='GET', post=None, referer='/',
+            cookies=(), remote_addr='127.0.0.1'):
+    headers = [('Referer', referer)]
+    cookie = []
+    if username:
+        cookie.append(login_cookie(main, username)[1])
+    cookie.extend(cookies)
+    if cookie:
+        headers.append(('Cookie', '; '.join(cookie)))
+    return main.app.get_response(path, method=method, POST=post,
+                                 headers=headers,
+                                 environ={'REMOTE_ADDR': remote_addr})
+
+
+# Create a post directly in the datastore and return its id. With legacy the
+# text is stored inline, as it was before article bodies were split out.
+def make_post(main, author, title="title", article="article", parent_post=0,
+              legacy=False):
+    if legacy:
+        entry = main.Entry(title=title, article=article, author=author,
+                           parent_post=parent_post, parent=main.blog_key())
+        entry.put()
+        return entry.key().id()
+    post_id = main.db.allocate_ids(main.db.Key.from_path(
+        'Entry', 1, parent=main.blog_key()), 1)[0]
+    entry = main.Entry(key=main.db.Key.from_path(
+        'Entry', post_id, parent=main.blog_key()), title=title,
+        author=author, parent_post=parent_post,
+        last_activity=None if parent_post else datetime.datetime.utcnow())
+    main.db.put(main.set_article(entry, article)[0])
+    return post_id
+
+
+# Counts the bytes of the datastore and memcache responses received while it
+# is installed, from an API proxy hook like main.RpcCounter.
+class ByteCounter(object):
+    def __init__(self):
+        self.bytes = 0
+        apiproxy_stub_map.apiproxy.GetPostCallHooks().Append(
+            'byte_counter', self.hook)
+
+    def hook(self, service, call, request, response, *args):
+        if service in ('datastore_v3', 'memcache'):
+            self.bytes += response.ByteSize()
+
+
+# Run the queued tasks through the app, and any they queue in turn, until the
+# queues are empty. Returns the number of tasks run.
+def run_tasks(main, queues=('default', 'search')):
+    stub = apiproxy_stub_map.apiproxy.GetStub('taskqueue')
+    run = 0
+    while True:
+        tasks = stub.get_filtered_tasks(queue_names=queues)
+        if not tasks:
+            return run
+        for queue in queues:
+            stub.FlushQueue(queue)
+        for task in tasks:
+            main.app.get_response(task.url, method='POST', body=task.payload,
+                headers=[('Content-Type',
+                          'application/x-www-form-urlencoded')])
+            run += 1
+
+
+# Return the pth percentile of a list of samples.
+def percentile(samples, p):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    index = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+# Results of the measurements reported so far, by name, for --json.
+RESULTS = {}
+
+# Print the latency of a measurement and record it in RESULTS, with any
+# extra figures given.
+def report(name, samples, **extra):
+    result = {"n": len(samples),
+              "mean": sum(samples) / max(len(samples), 1),
+              "p50": percentile(samples, 50),
+              "p95": percentile(samples, 95),
+              "p99": percentile(samples, 99)}
+    result.update(extra)
+    RESULTS[name] = result
+    print("%-28s n=%-5d mean=%8.2fms p50=%8.2fms p95=%8.2fms p99=%8.2fms" % (
+        name, result["n"], result["mean"], result["p50"], result["p95"],
+        result["p99"]))
+
+
+# Compare RESULTS with those of an earlier run, saved with --json, printing
+# the change in each measurement both runs have. A p99 more than tolerance
+# slower, or more datastore RPCs per request, is marked as a regression.
+def compare(baseline, tolerance):
+    regressions = 0
+    for name in sorted(set(RESULTS) & set(baseline)):
+        new, old = RESULTS[name], baseline[name]
+        change = lambda field: (new[field] - old[field]) / max(old[field],
+                                                               1e-9)
+        worse = (change("p99") > tolerance or
+                 new.get("rpcs", 0) > old.get("rpcs", 0) + 0.05)
+        regressions += worse
+        print("%-28s p50 %+6.0f%% p99 %+6.0f%%%s%s" % (
+            name, change("p50") * 100, change("p99") * 100,
+            " rpcs %.1f -> %.1f" % (old["rpcs"], new["rpcs"])
+            if "rpcs" in new and "rpcs" in old else "",
+            worse and "  REGRESSION" or ""))
+    return regressions
+
+
+# Call fn once per item and return the latency of each call in milliseconds.
+def timed(fn, items):
+    samples = []
+    for item in items:
+        start = time.time()
+        fn(item)
+        samples.append((time.time() - start) * 1000)
+    return samples
+
+
+
+
+###############################################################################
+
+#                               Scenarios
+
+###############################################################################
+
+
+# Latency of each write handler. Before read-your-writes consistency every one
+# of these slept for a full second.
+def bench_writes(main, args):
+    posts = [make_post(main, "alice") for _ in range(args.n)]
+
+    report("EditHandler.post", timed(
+        lambda pid: request(main, '/editpost/%d' % pid, "alice",
+                            method='POST', post={'content': 'edited'},
+                            cookies=['post_id=%d' % pid]), posts))
+    report("LikeHandler.get", timed(
+        lambda pid: request(main, '/like/%d' % pid, "bob"), posts))
+    report("UnLikeHandler.get", timed(
+        lambda pid: request(main, '/unlike/%d' % pid, "bob"), posts))
+    report("DeletePostHandler.get", timed(
+        lambda pid: request(main, '/deletepost/%d' % pid, "alice"), posts))
+
+
+# Concurrency stress test for the like subsystem. Many threads like (and some
+# like twice) the same post at once; afterwards the sharded total, read
+# straight from the datastore, must equal the number of distinct likers.
+def bench_likes(main, args):
+    from google.appengine.api import memcache
+    post_id = make_post(main, "alice")
+    users = ["user%d" % i for i in range(args.n)]
+    errors = []
+
+    def worker(username):
+        try:
+            main.likes.like(post_id, username)
+            main.likes.like(post_id, username)
+        except Exception as e:
+            errors.append(e)
+
+    start = time.time()
+    threads = [threading.Thread(target=worker, args=(u,)) for u in users]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    memcache.flush_all()
+    entry = main.Entry.get_by_id(post_id, parent=main.blog_key())
+    total = main.likes.counts([entry])[post_id]
+    members = main.LikeMembership.all().filter('post_id =', post_id).count()
+    print("%d concurrent likers in %.2fs: count=%d memberships=%d errors=%d"
+          % (len(users), elapsed, total, members, len(errors)))
+    if total != len(users) or members != len(users) or errors:
+        print("FAIL: lost or duplicated like updates")
+        sys.exit(1)
+
+
+# Datastore round trips and latency of a comment thread page.
+def bench_postpage(main, args):
+    post_id = make_post(main, "alice")
+    for i in range(main.COMMENT_PAGE_SIZE):
+        make_post(main, "bob", parent_post=post_id)
+    path = '/postcomment/%d' % post_id
+    request(main, path, "carol")
+    samples = timed(lambda _: request(main, path, "carol"), range(args.n))
+    report("PostCommentHandler.get", samples)
+    print("datastore RPCs per page: %d %r" % (main.rpc_counter.count(),
+                                              main.rpc_counter.calls()))
+
+
+# Latency of the read handlers. Run with --latency to see the effect of issuing
+# their datastore calls in parallel.
+def bench_pages(main, args):
+    post_id = make_post(main, "alice")
+    for i in range(main.COMMENT_PAGE_SIZE * 2):
+        make_post(main, "bob", parent_post=post_id)
+    for i in range(main.FRONT_PAGE_SIZE * 2):
+        make_post(main, "alice")
+    older = main.fetch_page(0)[2]
+
+    for name, path in [
+            ("MainHandler.get", '/'),
+            ("MainHandler.get (page 2)", '/?cursor=%s' % older),
+            ("CommentHandler.get", '/comment/%d' % post_id),
+            ("PostCommentHandler.get", '/postcomment/%d' % post_id)]:
+        request(main, path, "carol")
+        report(name, timed(lambda _: request(main, path, "carol"),
+                           range(args.n)))
+
+
+# Time to first byte of the first request to each route on a new instance:
+# with nothing compiled, with template bytecode already in memcache, and after
+# a warmup request has compiled every template.
+def bench_coldstart(main, args):
+    from google.appengine.api import memcache
+    post_id = make_post(main, "alice")
+    routes = ['/', '/newpost', '/signup', '/login', '/welcome',
+              '/post/%d' % post_id, '/postcomment/%d' % post_id,
+              '/comment/%d' % post_id, '/editpost/%d' % post_id]
+
+    def first_requests(name):
+        for path in routes:
+            samples = timed(lambda _: request(main, path, "alice"), [None])
+            report("%s %s" % (name, path), samples)
+
+    main.jinja_env.cache.clear()
+    memcache.flush_all()
+    first_requests("cold")
+
+    main.jinja_env.cache.clear()
+    first_requests("bytecode")
+
+    main.jinja_env.cache.clear()
+    request(main, '/_ah/warmup')
+    first_requests("warm")
+
+
+# Render a 1,000 comment thread on one page, buffered and streamed. Reports
+# the time until the first chunk is written and the largest single string
+# the handler had to hold.
+def bench_stream(main, args):
+    post_id = make_post(main, "alice")
+    for i in range(1000):
+        make_post(main, "bob", article="comment %d " % i * 20,
+                  parent_post=post_id)
+    main.COMMENT_PAGE_SIZE = 1000
+    path = '/postcomment/%d' % post_id
+    write = main.Handler.write
+    stats = {}
+
+    def recording_write(handler, data, *a, **kw):
+        if 'first' not in stats:
+            stats['first'] = time.time()
+        stats['largest'] = max(stats.get('largest', 0), len(data))
+        write(handler, data, *a, **kw)
+    main.Handler.write = recording_write
+
+    try:
+        for stream in (False, True):
+            main.PostCommentHandler.stream = stream
+            ttfb, largest = [], []
+            for _ in range(args.n):
+                stats.clear()
+                start = time.time()
+                request(main, path, "carol")
+                ttfb.append((stats['first'] - start) * 1000)
+                largest.append(stats['largest'])
+            report("%s TTFB" % ("streamed" if stream else "buffered"), ttfb)
+            print("%-28s largest write=%d bytes" % ("", max(largest)))
+    finally:
+        main.Handler.write = write
+
+
+# Per-request cost of finding out who the user is: the old path checked the
+# signed name cookie (up to three times per request), the session path loads
+# the session once and reads it from the handler after that.
+def bench_session(main, args):
+    import webapp2
+    cookie = "alice|%s" % main.hash_str("alice")
+    sid = main.sessions.cookie_value(main.sessions.create("alice"))
+
+    def cookie_path(_):
+        for _ in range(3):
+            main.check_legacy_val(cookie)
+
+    def session_path(_):
+        request = webapp2.Request.blank('/', headers=[('Cookie',
+                                                       'sid=%s' % sid)])
+        handler = main.Handler(request, webapp2.Response())
+        for _ in range(3):
+            handler.username
+
+    report("name cookie x3", timed(cookie_path, range(args.n)))
+    report("session (LRU hit)", timed(session_path, range(args.n)))
+    main.sessions.local.delete(main.check_secure_val(sid))
+    report("session (first load)", timed(session_path, [None]))
+
+
+# Latency and datastore round trips of signing up and logging in.
+def bench_accounts(main, args):
+    names = ["user%d" % i for i in range(args.n)]
+    calls = {}
+
+    def measure(name, fn):
+        def run(item):
+            fn(item)
+            for call, n in main.rpc_counter.calls().items():
+                calls.setdefault(name, {})
+                calls[name][call] = calls[name].get(call, 0) + n
+        report(name, timed(run, names))
+        print("%-28s datastore calls per request: %s" % ("", ", ".join(
+            "%s=%.1f" % (c, float(n) / len(names))
+            for c, n in sorted(calls.get(name, {}).items()))))
+
+    measure("SignUpHandler.post", lambda name: request(main, '/signup',
+        method='POST', post={'username': name, 'password': 'secret',
+                             'verify': 'secret',
+                             'email': name + '@example.com'}))
+    measure("LoginHandler.post", lambda name: request(main, '/login',
+        method='POST', post={'username': name, 'password': 'secret'}))
+
+
+# Throughput of signing and checking cookies: the MD5 functions cookies used
+# before, against HMAC-SHA256 with the keyring.
+def bench_signing(main, args):
+    count = args.n * 1000
+    legacy_sign = lambda s: "%s|%s" % (s, main.hash_str(s))
+    keyring = main.keyring.get()
+    signed_legacy = legacy_sign("alice")
+    signed = keyring.sign("alice")
+
+    for name, fn, arg in [
+            ("md5 sign", legacy_sign, "alice"),
+            ("md5 verify", main.check_legacy_val, signed_legacy),
+            ("hmac sign", keyring.sign, "alice"),
+            ("hmac verify", keyring.verify, signed)]:
+        start = time.time()
+        for _ in range(count):
+            fn(arg)
+        elapsed = time.time() - start
+        print("%-28s %10.0f ops/s" % (name, count / elapsed))
+
+
+# Stand-in for a memcache client shared by every instance: one dictionary
+# behind a lock, with the same gets/add/cas semantics. Each client keeps its
+# own record of what it fetched with gets, like a memcache.Client.
+class SharedStore(object):
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def client(self):
+        return SharedClient(self)
+
+
+class SharedClient(object):
+    def __init__(self, store):
+        self.store = store
+        self.fetched = {}
+
+    def gets(self, key):
+        with self.store.lock:
+            version, value = self.store.values.get(key, (None, None))
+        self.fetched[key] = version
+        return value
+
+    def add(self, key, value, time=0):
+        with self.store.lock:
+            if key in self.store.values:
+                return False
+            self.store.values[key] = (0, value)
+            return True
+
+    def cas(self, key, value, time=0):
+        with self.store.lock:
+            version, _ = self.store.values.get(key, (None, None))
+            if version is None or version != self.fetched.get(key):
+                return False
+            self.store.values[key] = (version + 1, value)
+            return True
+
+
+# Cost of the rate limiter and whether it holds under concurrent load.
+# Several limiters, standing in for instances, share one bucket; many threads
+# hit each of them at once and no more than the bucket's size may get
+# through. Then times requests the limiter turns away, by address and by
+# session, and fails if the session one makes any RPCs.
+def bench_ratelimit(main, args):
+    limit = main.RateLimit("bench", 100, 3600, "ip")
+    store = SharedStore()
+
+    local = main.RateLimiter()
+    report("check (local only)", timed(
+        lambda i: local.check(limit, str(i)), range(args.n)))
+    shared = main.RateLimiter(client=store.client)
+    report("check (shared, allowed)", timed(
+        lambda i: shared.check(limit, str(i)), range(args.n)))
+    for _ in range(limit.requests):
+        shared.check(limit, "busy")
+    report("check (rejected)", timed(
+        lambda _: shared.check(limit, "busy"), range(args.n)))
+
+    limiters = [main.RateLimiter(client=store.client) for _ in range(4)]
+    allowed = []
+
+    def worker(limiter):
+        for _ in range(limit.requests):
+            if not limiter.check(limit, "crowd"):
+                allowed.append(1)
+
+    threads = [threading.Thread(target=worker, args=(limiters[i % 4],))
+               for i in range(args.n)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    print("%d threads on %d instances in %.2fs: %d of %d requests allowed"
+          % (len(threads), len(limiters), elapsed, len(allowed),
+             len(threads) * limit.requests))
+    refilled = elapsed * limit.requests / limit.seconds
+    if len(allowed) > limit.requests + refilled:
+        print("FAIL: more requests allowed than the limit")
+        sys.exit(1)
+
+    post = {'username': 'nobody', 'password': 'secret'}
+    for _ in range(main.LoginHandler.rate_limits["POST"][0].requests):
+        request(main, '/login', method='POST', post=post)
+    samples = timed(lambda _: request(main, '/login', method='POST',
+                                      post=post), range(args.n))
+    report("LoginHandler.post (429)", samples)
+    print("%-28s datastore calls per request: %d" % (
+        "", main.rpc_counter.count()))
+
+    # A session limit is keyed on the cookie alone, so turning a request away
+    # must not load the signing keys to verify it, even when they are stale.
+    post_id = make_post(main, "alice")
+    for _ in range(main.LikeHandler.rate_limits["GET"][0].requests):
+        request(main, '/like/%d' % post_id, username="alice")
+    main.keyring.keyring = None
+    request(main, '/like/%d' % post_id, username="alice")
+    rpcs = main.rpc_counter.count()
+    report("LikeHandler.get (429)", timed(
+        lambda _: request(main, '/like/%d' % post_id, username="alice"),
+        range(args.n)))
+    print("%-28s datastore calls per request: %d" % ("", rpcs))
+    if rpcs:
+        print("FAIL: a rejected request made datastore calls")
+        sys.exit(1)
+
+
+# Deleting a post with many comments. The request only deletes the post; the
+# comments go in background batches, after which none may be left. Then
+# orphans a post's comments the old way and checks the reaper removes them.
+def bench_delete(main, args):
+    comments = args.n * 20
+    post_id = make_post(main, "alice")
+    for i in range(comments):
+        make_post(main, "bob", parent_post=post_id)
+
+    samples = timed(lambda _: request(main, '/deletepost/%d' % post_id,
+                                      "alice"), [None])
+    report("DeletePostHandler.get", samples)
+    start = time.time()
+    tasks = run_tasks(main)
+    print("%d comments deleted by %d tasks in %.2fs" % (
+        comments, tasks, time.time() - start))
+
+    orphaned = make_post(main, "alice")
+    for i in range(args.n):
+        make_post(main, "bob", parent_post=orphaned)
+    main.Entry.get_by_id(orphaned, parent=main.blog_key()).delete()
+    request(main, '/_admin/tasks/reapcomments', method='POST', post={})
+    run_tasks(main)
+
+    left = main.Entry.all().filter('parent_post IN', [post_id, orphaned])
+    if left.count():
+        print("FAIL: %d comments left behind" % left.count())
+        sys.exit(1)
+
+
+# Build a thread of count comments on a new post, each a reply to a random
+# earlier comment (or the post), writing them directly in batches. Returns
+# the post id.
+def make_thread(main, count):
+    post_id = make_post(main, "alice")
+    ids = main.db.allocate_ids(main.db.Key.from_path(
+        'Entry', 1, parent=main.blog_key()), count)
+    created = datetime.datetime.utcnow()
+    paths = []
+    batch = []
+    for i in range(count):
+        entry_id = ids[0] + i
+        parent = random.randint(-1, i - 1) if i else -1
+        path = paths[parent] if parent >= 0 else ""
+        if path.count('/') >= main.MAX_THREAD_DEPTH:
+            path = path[:path.rindex('/', 0, -1) + 1]
+        created += datetime.timedelta(microseconds=1)
+        path += main.path_segment(created, entry_id)
+        paths.append(path)
+        ids_above = main.path_ids(path)
+        batch.append(main.Entry(
+            key=main.db.Key.from_path('Entry', entry_id,
+                                      parent=main.blog_key()),
+            title="reply", article="article", author="bob",
+            created=created, parent_post=post_id, path=path,
+            reply_to=ids_above[-2] if len(ids_above) > 1 else None))
+        if len(batch) == 500:
+            main.db.put(batch)
+            batch = []
+    main.db.put(batch)
+    return post_id
+
+
+# Fetching and arranging a large comment thread: the whole thread and one
+# comment's replies each come from a single query in thread order, and
+# build_thread turns the flat list into trees. Checks every reply ends up
+# under the comment it answers.
+def bench_thread(main, args):
+    count = args.n * 200
+    start = time.time()
+    post_id = make_thread(main, count)
+    print("built a %d comment thread in %.2fs" % (count, time.time() - start))
+
+    def fetch(_):
+        return main.start_thread(post_id, size=count)()[0]
+    report("fetch whole thread", timed(fetch, range(3)))
+    entries = fetch(None)
+    views = [main.ArticleView(e) for e in entries]
+    report("build_thread", timed(lambda _: main.build_thread(
+        [main.ArticleView(e) for e in entries]), range(3)))
+
+    roots = main.build_thread(views)
+    by_id = dict((e.key().id(), e) for e in entries)
+    placed = []
+
+    def walk(view, parent_id):
+        placed.append(view)
+        entry = by_id[view.id]
+        if (entry.reply_to or None) != parent_id:
+            raise ValueError("comment %d placed under %s" % (view.id,
+                                                             parent_id))
+        for child in view.children:
+            walk(child, view.id)
+    try:
+        for root in roots:
+            walk(root, None)
+    except ValueError as e:
+        print("FAIL: %s" % e)
+        sys.exit(1)
+    if len(entries) != count or len(placed) != count:
+        print("FAIL: %d of %d comments fetched, %d placed" % (
+            len(entries), count, len(placed)))
+        sys.exit(1)
+
+    largest = max(roots, key=lambda v: len(v.children))
+    report("fetch one subtree", timed(lambda _: main.start_thread(
+        post_id, size=count, within=largest.path)(), range(3)))
+    path = '/postcomment/%d' % post_id
+    report("PostCommentHandler.get", timed(
+        lambda _: request(main, path, "carol"), range(args.n)))
+    report("add_comment (deep reply)", timed(
+        lambda _: main.add_comment(post_id, entries[-1].key().id(),
+                                   "reply", "article", "carol"),
+        range(args.n)))
+
+
+# Comment counts and last activity kept on posts. Comments added through
+# add_comment must leave each post with the right count and the time of its
+# newest comment; the front page, in both orders, must use one query however
+# many posts it shows; and the repair job must put back counts that have been
+# damaged.
+def bench_activity(main, args):
+    posts = []
+    for i in range(main.FRONT_PAGE_SIZE):
+        post_id = make_post(main, "alice")
+        entry = main.Entry.get_by_id(post_id, parent=main.blog_key())
+        entry.last_activity = entry.created
+        entry.put()
+        posts.append(post_id)
+    expected = {}
+    samples = []
+    for i in range(args.n):
+        post_id = random.choice(posts)
+        start = time.time()
+        main.add_comment(post_id, None, "comment", "article", "bob")
+        samples.append((time.time() - start) * 1000)
+        expected[post_id] = expected.get(post_id, 0) + 1
+    report("add_comment", samples)
+
+    def check(when):
+        entries = main.db.get([main.db.Key.from_path(
+            'Entry', post_id, parent=main.blog_key()) for post_id in posts])
+        for post_id, entry in zip(posts, entries):
+            if entry.comment_count != expected.get(post_id, 0):
+                print("FAIL: post %d has comment_count %d %s, expected %d" %
+                      (post_id, entry.comment_count, when,
+                       expected.get(post_id, 0)))
+                sys.exit(1)
+            if entry.last_activity is None:
+                print("FAIL: post %d has no last_activity %s" % (post_id,
+                                                                 when))
+                sys.exit(1)
+        return entries
+    entries = check("after comments")
+
+    for path in ('/', '/?sort=active'):
+        request(main, path, "carol")
+        samples = timed(lambda _: request(main, path, "carol"), range(args.n))
+        report("MainHandler.get %s" % path, samples)
+        print("%-28s queries per request: %d" % (
+            "", main.rpc_counter.calls().get('RunQuery', 0)))
+
+    for entry in entries:
+        entry.comment_count = 0
+        entry.last_activity = None
+    main.db.put(entries)
+    request(main, '/_admin/repair/comments', method='POST', post={})
+    run_tasks(main)
+    check("after repair")
+
+
+# Query latency of full-text search over a synthetic corpus of args.n * 2000
+# documents (100,000 by default) drawn from a Zipf distributed vocabulary, so
+# that a few terms are in most documents and most terms in few. Rankings are
+# compared with exact BM25 computed over the whole corpus in memory, and an
+# edit and a delete must show up in the results.
+def bench_search(main, args):
+    import search
+    rng = random.Random(1)
+    vocabulary = ["w%d" % i for i in range(20000)]
+    weights = [1.0 / (i + 1) for i in range(len(vocabulary))]
+    total = sum(weights)
+    cumulative = []
+    acc = 0.0
+    for w in weights:
+        acc += w / total
+        cumulative.append(acc)
+
+    def word():
+        return vocabulary[min(bisect.bisect(cumulative, rng.random()),
+                              len(vocabulary) - 1)]
+
+    count = args.n * 2000
+    corpus = {}
+    start = time.time()
+    batch = {}
+    for doc_id in range(1, count + 1):
+        corpus[doc_id] = " ".join(word() for _ in range(rng.randint(5, 30)))
+        batch[doc_id] = corpus[doc_id]
+        if len(batch) == 100:
+            search.update(batch)
+            batch = {}
+    if batch:
+        search.update(batch)
+    print("indexed %d documents in %.1fs" % (count, time.time() - start))
+
+    tokens = dict((doc_id, search.tokenize(text))
+                  for doc_id, text in corpus.items())
+    average = sum(len(t) for t in tokens.values()) / float(len(tokens))
+
+    def exact(query, size=10):
+        terms = set(search.tokenize(query))
+        docs = dict((doc_id, t) for doc_id, t in tokens.items()
+                    if terms & set(t))
+        df = dict((t, sum(1 for d in docs.values() if t in d))
+                  for t in terms)
+        scores = {}
+        for doc_id, words in docs.items():
+            scores[doc_id] = sum(
+                search.weight(words.count(t), len(words), average,
+                              search.idf(df[t], len(corpus)))
+                for t in terms if t in words)
+        ranked = sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+        return [doc_id for doc_id, _ in ranked[:size]]
+
+    queries = {
+        "common": "w0",
+        "two common": "w1 w2",
+        "mixed": "w3 w500",
+        "rare": "w5000 w9000",
+        "three": "w10 w100 w1000",
+    }
+    agreement = []
+    for name, query in sorted(queries.items()):
+        for page in (0, 4):
+            samples = timed(lambda _: search.search(query, page),
+                            range(args.n))
+            report("%s, page %d" % (name, page), samples)
+        found = [doc_id for doc_id, _ in search.search(query).hits]
+        expected = exact(query)
+        agreement.append(len(set(found) & set(expected)) /
+                         float(max(len(expected), 1)))
+    print("top 10 overlap with exact BM25: %.0f%%" % (
+        100 * sum(agreement) / len(agreement)))
+
+    target = rng.randint(1, count)
+    search.update({target: "zzunique zzunique"})
+    if [d for d, _ in search.search("zzunique").hits] != [target]:
+        print("FAIL: edited document not found by its new text")
+        sys.exit(1)
+    search.update({target: None})
+    if search.search("zzunique").hits:
+        print("FAIL: deleted document still found")
+        sys.exit(1)
+
+
+# Profile pages over a large synthetic dataset: args.n * 400 posts and
+# comments (20,000 by default) spread over 200 authors. Each page is one query
+# whatever the size of the dataset or how deep the page is; run with
+# --require-indexes to check index.yaml covers every query made. Then checks
+# that user totals kept on write, and those put right by the repair job,
+# match what each user has written.
+def bench_profile(main, args):
+    authors = ["author%d" % i for i in range(200)]
+    for name in authors:
+        main.Users(key=main.user_key(name), user_name=main.hash_str(name),
+                   password="x").put()
+    rng = random.Random(1)
+    created = datetime.datetime.utcnow()
+    batch = []
+    posts = []
+    for i in range(args.n * 400):
+        created += datetime.timedelta(microseconds=1)
+        parent = rng.choice(posts) if posts and rng.random() < 0.7 else 0
+        entry = main.Entry(title="title", article="article",
+                           author=rng.choice(authors), parent_post=parent,
+                           created=created, parent=main.blog_key())
+        batch.append(entry)
+        if len(batch) == 500 or not parent:
+            main.db.put(batch)
+            posts.extend(e.key().id() for e in batch if not e.parent_post)
+            batch = []
+    main.db.put(batch)
+    print("%d entries by %d authors" % (args.n * 400, len(authors)))
+
+    for show, parent_post in (("", None), ("?show=posts", 0)):
+        for depth in (0, 5):
+            cursor = None
+            for _ in range(depth):
+                cursor = main.fetch_page(parent_post, cursor,
+                                         main.PROFILE_PAGE_SIZE,
+                                         author="author0")[2]
+            url = '/user/author0' + show
+            if cursor:
+                url += (show and "&" or "?") + "cursor=" + cursor
+            samples = timed(lambda _: request(main, url, "carol"),
+                            range(args.n))
+            report("/user/author0%s page %d" % (show, depth + 1), samples)
+            print("%-28s queries per request: %d" % (
+                "", main.rpc_counter.calls().get('RunQuery', 0)))
+
+    request(main, '/_admin/repair/users', method='POST', post={})
+    run_tasks(main)
+    checked = authors[:10] + ["writer"]
+    writer_post = None
+    for i in range(5):
+        response = request(main, '/newpost', "writer", method='POST',
+                           post={'subject': 'title', 'content': 'article'})
+        writer_post = int(response.headers['Location'].rsplit('/', 1)[-1])
+    main.add_comment(writer_post, None, "title", "article", "writer")
+    main.likes.like(writer_post, "carol", "writer")
+    main.memcache.flush_all()
+    for name in checked:
+        entries = list(main.Entry.all().filter('author =', name))
+        expected = {
+            "posts": sum(1 for e in entries if not e.parent_post),
+            "comments": sum(1 for e in entries if e.parent_post),
+            "likes": sum(main.likes.counts(entries).values()) if entries
+                     else 0,
+        }
+        stats = main.user_stats.get(name)
+        if stats != expected:
+            print("FAIL: %s has totals %s, expected %s" % (name, stats,
+                                                          expected))
+            sys.exit(1)
+
+
+# Front page and post page render times with the fragment cache off (no
+# capacity, so every fragment is rendered) and on, and the cache's hit rate.
+def bench_fragments(main, args):
+    posts = [make_post(main, "alice", article="article " * 200)
+             for _ in range(main.FRONT_PAGE_SIZE)]
+    for i in range(main.COMMENT_PAGE_SIZE):
+        main.add_comment(posts[0], None, "comment", "comment " * 100, "bob")
+    paths = ['/', '/postcomment/%d' % posts[0]]
+    cache = main.fragment_cache
+    for capacity in (0, 4 * 1024 * 1024):
+        cache.cache = main.LRUCache(capacity, weigh=len)
+        cache.hits = cache.misses = 0
+        for path in paths:
+            request(main, path, "carol")
+            report("%s (cache %s)" % (path, capacity and "on" or "off"),
+                   timed(lambda _: request(main, path, "carol"),
+                         range(args.n)))
+        stats = cache.stats()
+        print("%-28s hit rate %.0f%%, %d fragments, %d characters" % (
+            "", stats["hit_rate"] * 100, stats["entries"], stats["size"]))
+
+
+# Edit one long post many times, changing a few lines each time, then compare
+# the space the history takes with keeping every version whole, and time
+# rebuilding old versions. Every version must come back exactly as written.
+def bench_revisions(main, args):
+    import revisions
+    lines = ["line %d of a long article, with some words in it\n" % i
+             for i in range(400)]
+    post_id = make_post(main, "alice", article="".join(lines))
+    versions = ["".join(lines)]
+    edit = lambda _: request(main, '/editpost/%d' % post_id, "alice",
+        method='POST', post={'content': versions[-1]},
+        cookies=['post_id=%d' % post_id])
+    def change(_):
+        for _ in range(random.randint(1, 3)):
+            i = random.randrange(len(lines))
+            choice = random.random()
+            if choice < 0.6:
+                lines[i] = "line changed at %f\n" % random.random()
+            elif choice < 0.8:
+                lines.insert(i, "line added at %f\n" % random.random())
+            elif len(lines) > 1:
+                del lines[i]
+        versions.append("".join(lines))
+        edit(None)
+    report("EditHandler.post", timed(change, range(args.n * 10)))
+
+    entry = main.Entry.get_by_id(post_id, parent=main.blog_key())
+    history = revisions.history(entry.key(), entry.revision_count)
+    stored = sum(len(r.data) for r in history)
+    whole = sum(len(v.encode('utf-8')) for v in versions)
+    print("%d revisions in %d bytes, %d bytes kept whole (%.1f%%)" % (
+        len(history), stored, whole, 100.0 * stored / whole))
+
+    numbers = [random.randrange(len(versions)) for _ in range(args.n)]
+    report("revisions.text", timed(
+        lambda n: revisions.text(entry.key(), n), numbers))
+    report("RevisionHandler.get", timed(
+        lambda n: request(main, '/post/%d/rev/%d' % (post_id, n), "bob"),
+        numbers))
+    for n, version in enumerate(versions):
+        if revisions.text(entry.key(), n) != version:
+            print("FAIL: revision %d does not match what was written" % n)
+            sys.exit(1)
+
+
+# Bytes read from the datastore and memcache per front page render, with
+# long posts stored the old way, whole in the entry, and after
+# /_admin/backfill/bodies has moved their text out to compressed bodies.
+# Cold renders rebuild the cached front page list; warm ones read it from
+# memcache. The post page must still show the whole text.
+def bench_bodies(main, args):
+    from google.appengine.api import memcache
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+             "adipiscing", "elit", "sed", "eiusmod", "tempor", "labore"]
+    texts = [" ".join(random.choice(words) for _ in range(1000))
+             for _ in range(main.FRONT_PAGE_SIZE)]
+    posts = [make_post(main, "alice", article=text, legacy=True)
+             for text in texts]
+    counter = ByteCounter()
+
+    def render(cold):
+        if cold:
+            main.front_page_cache.invalidate()
+            memcache.flush_all()
+        main.front_page_cache.local = None
+        request(main, '/')
+
+    for stage in ("before", "after"):
+        if stage == "after":
+            request(main, '/_admin/backfill/bodies')
+            run_tasks(main)
+        for cold in (True, False):
+            render(cold)
+            counter.bytes = 0
+            name = "/ %s (%s)" % (stage, cold and "cold" or "warm")
+            report(name, timed(lambda _: render(cold), range(args.n)))
+            print("%-28s %d bytes read per render" % (
+                "", counter.bytes // args.n))
+
+    for post_id, text in zip(posts, texts):
+        body = request(main, '/postcomment/%d' % post_id).body
+        if text not in body:
+            print("FAIL: post %d does not show its whole text" % post_id)
+            sys.exit(1)
+
+
+# Throughput of bulk.py at args.n * 20000 entities, a million by default: a
+# file of users and entries is imported and exported again, and every text
+# must survive the trip. Peak memory is reported too, though the local
+# datastore stub holds all the data in memory itself. An export stopped part
+# way and resumed must write the same file as one run straight through.
+def bench_bulk(main, args):
+    import bulk
+    count = args.n * 20000
+    users = max(count // 20, 1)
+    directory = tempfile.mkdtemp()
+    source = os.path.join(directory, "source.jsonl")
+    created = "2016-01-01T00:00:00.000000"
+    # Every tenth entry is long enough to be kept in an EntryBody.
+    text = lambda i: "article %d " % i * (i % 10 and 5 or 100)
+    with open(source, 'wb') as f:
+        for i in range(count):
+            if i < users:
+                name = main.hash_str("user%d" % i)
+                record = {"kind": "Users", "key": ["Users", name],
+                          "properties": {"user_name": name, "password": "x",
+                                         "email": "user%d@example.com" % i,
+                                         "created": created}}
+            else:
+                record = {"kind": "Entry",
+                          "key": ["blogs", "default", "Entry", i],
+                          "properties": {"title": "post %d" % i,
+                                         "article": text(i),
+                                         "author": "user%d" % (i % users),
+                                         "parent_post": 0,
+                                         "created": created}}
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+
+    def run(name, fn):
+        memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        done = fn()
+        elapsed = time.time() - start
+        print("%-28s %d entities in %.1fs (%.0f/s), peak memory +%d KB" % (
+            name, done, elapsed, done / max(elapsed, 1e-9),
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - memory))
+
+    run("bulk.import_file", lambda: bulk.import_file(main, source))
+    exported = os.path.join(directory, "export.jsonl")
+    run("bulk.export_file", lambda: bulk.export_file(main, exported))
+
+    seen = 0
+    with open(exported, 'rb') as f:
+        for line in f:
+            record = json.loads(line)
+            seen += 1
+            if (record["kind"] == "Entry" and
+                    record["properties"]["article"] != text(
+                        record["key"][-1])):
+                print("FAIL: entry %d came back changed" % record["key"][-1])
+                sys.exit(1)
+    if seen != count:
+        print("FAIL: %d entities exported, %d imported" % (seen, count))
+        sys.exit(1)
+
+    resumed = os.path.join(directory, "resumed.jsonl")
+    bulk.export_file(main, resumed, max_batches=3)
+    bulk.export_file(main, resumed)
+    if not filecmp.cmp(exported, resumed, shallow=False):
+        print("FAIL: resumed export differs from a straight one")
+        sys.exit(1)
+    shutil.rmtree(directory)
+
+
+# Password of the users made by seed().
+SEED_PASSWORD = "password"
+
+SEED_WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+              "adipiscing", "elit", "sed", "eiusmod", "tempor", "labore"]
+
+# Random text of about words words.
+def seed_text(words):
+    return " ".join(random.choice(SEED_WORDS) for _ in range(words))
+
+# Fill the datastore with args.users users and args.posts posts, each with
+# args.comments comments, some of them replies, and args.likes likes. A few
+# posts are edited twice, so they have a history, and every post is indexed
+# for search. Returns the user names and a list of (post id, author) pairs.
+def seed(main, args):
+    users = ["user%d" % i for i in range(max(args.users, 1))]
+    for name in users:
+        main.CreateUser().create(name, "%s@example.com" % name, SEED_PASSWORD)
+        login_cookie(main, name)
+    posts = []
+    for i in range(args.posts):
+        author = users[i % len(users)]
+        # One post in ten is long enough to be kept in an EntryBody.
+        posts.append((make_post(main, author, title="post %d" % i,
+                                article=seed_text(i % 10 and 50 or 400)),
+                      author))
+    for post_id, author in posts:
+        comments = []
+        for i in range(args.comments):
+            reply_to = random.choice([None] + comments)
+            comment = main.add_comment(post_id, reply_to, "comment",
+                                       seed_text(20), random.choice(users))
+            comments.append(comment.key().id())
+        others = [u for u in users if u != author]
+        for name in random.sample(others, min(args.likes, len(others))):
+            main.likes.like(post_id, name, author)
+    for post_id, author in posts[:10]:
+        for _ in range(2):
+            request(main, '/editpost/%d' % post_id, author, method='POST',
+                    post={'content': seed_text(50)},
+                    cookies=['post_id=%d' % post_id])
+    main.index_later([post_id for post_id, _ in posts])
+    run_tasks(main)
+    return users, posts
+
+
+# Send the requests given by specs, a list of keyword arguments for request(),
+# from clients threads at once. Returns the latency of each request, the
+# datastore RPCs it made, the number of requests that failed with a server
+# error, and the time taken for them all.
+def drive(main, specs, clients):
+    pending = list(reversed(specs))
+    lock = threading.Lock()
+    samples = []
+    rpcs = []
+    errors = []
+
+    def worker():
+        while True:
+            with lock:
+                if not pending:
+                    return
+                spec = pending.pop()
+            start = time.time()
+            response = request(main, **spec)
+            elapsed = (time.time() - start) * 1000
+            with lock:
+                samples.append(elapsed)
+                rpcs.append(main.rpc_counter.count())
+                if response.status_int >= 500:
+                    errors.append(spec["path"])
+
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return samples, rpcs, len(errors), time.time() - start
+
+
+# Every route in main.app, args.n requests each from args.clients concurrent
+# clients, against data made by seed(). Reports throughput, latency and
+# datastore RPCs per request for each route. Read-only routes run first,
+# then writes, deletes and the admin jobs, each driven by the task request
+# that does its work. Server errors fail the run.
+def bench_routes(main, args):
+    users, posts = seed(main, args)
+    edited = posts[:10]
+    pick = lambda i: posts[i % len(posts)]
+    user = lambda i: users[i % len(users)]
+    # Someone other than the author of pick(i), if there is anyone.
+    liker = lambda i: users[(users.index(pick(i)[1]) + 1 +
+                             i % max(len(users) - 1, 1)) % len(users)]
+
+    # A new post of users[0] with comments, to be deleted; with orphan the
+    # post itself is already gone, leaving its comments for the task.
+    def victim(orphan=False):
+        post_id = make_post(main, users[0])
+        for i in range(args.comments):
+            main.add_comment(post_id, None, "comment", "comment", user(i))
+        if orphan:
+            main.Entry.get_by_id(post_id, parent=main.blog_key()).delete()
+        return post_id
+
+    routes = [
+        ("GET /", lambda i: dict(path='/', username=user(i))),
+        ("GET /?sort=active", lambda i: dict(path='/?sort=active',
+                                             username=user(i))),
+        ("GET /welcome", lambda i: dict(path='/welcome', username=user(i))),
+        ("GET /signup", lambda i: dict(path='/signup')),
+        ("GET /login", lambda i: dict(path='/login')),
+        ("GET /newpost", lambda i: dict(path='/newpost', username=user(i))),
+        ("GET /post/<id>", lambda i: dict(path='/post/%d' % pick(i)[0],
+                                          username=user(i))),
+        ("GET /post/<id>/history", lambda i: dict(
+            path='/post/%d/history' % edited[i % len(edited)][0],
+            username=user(i))),
+        ("GET /post/<id>/rev/<n>", lambda i: dict(
+            path='/post/%d/rev/%d' % (edited[i % len(edited)][0], i % 3),
+            username=user(i))),
+        ("GET /editpost/<id>", lambda i: dict(
+            path='/editpost/%d' % pick(i)[0], username=pick(i)[1])),
+        ("GET /comment/<id>", lambda i: dict(
+            path='/comment/%d' % pick(i)[0], username=user(i))),
+        ("GET /postcomment/<id>", lambda i: dict(
+            path='/postcomment/%d' % pick(i)[0], username=user(i))),
+        ("GET /canceledit", lambda i: dict(path='/canceledit',
+                                           cookies=['referrer_url=/'])),
+        ("GET /search", lambda i: dict(
+            path='/search?q=%s' % random.choice(SEED_WORDS),
+            username=user(i))),
+        ("GET /user/<name>", lambda i: dict(path='/user/%s' % user(i),
+                                            username=user(i + 1))),
+        ("GET /_stats/cache", lambda i: dict(path='/_stats/cache')),
+        ("GET /_ah/warmup", lambda i: dict(path='/_ah/warmup')),
+        ("POST /signup", lambda i: dict(path='/signup', method='POST', post={
+            'username': 'signup%d' % i, 'password': SEED_PASSWORD,
+            'verify': SEED_PASSWORD, 'email': 'signup%d@example.com' % i})),
+        ("POST /login", lambda i: dict(path='/login', method='POST', post={
+            'username': user(i), 'password': SEED_PASSWORD})),
+        ("GET /logout", lambda i: dict(path='/logout', cookies=[
+            'sid=%s' % main.sessions.cookie_value(
+                main.sessions.create(user(i)))])),
+        ("POST /newpost", lambda i: dict(path='/newpost', username=user(i),
+            method='POST', post={'subject': 'new post %d' % i,
+                                 'content': seed_text(50)})),
+        ("POST /editpost/<id>", lambda i: dict(
+            path='/editpost/%d' % pick(i)[0], username=pick(i)[1],
+            method='POST', post={'content': seed_text(50)},
+            cookies=['post_id=%d' % pick(i)[0]])),
+        ("GET /like/<id>", lambda i: dict(path='/like/%d' % pick(i)[0],
+                                          username=liker(i))),
+        ("GET /unlike/<id>", lambda i: dict(path='/unlike/%d' % pick(i)[0],
+                                            username=liker(i))),
+        ("POST /comment/<id>", lambda i: dict(
+            path='/comment/%d' % pick(i)[0], username=user(i),
+            method='POST', post={'subject': 'comment',
+                                 'content': seed_text(20),
+                                 'parentid': str(pick(i)[0]),
+                                 'reply_to': ''})),
+        ("GET /deletepost/<id>", lambda i: dict(
+            path='/deletepost/%d' % victim(), username=users[0])),
+        ("POST /_admin/tasks/deletecomments", lambda i: dict(
+            path='/_admin/tasks/deletecomments', method='POST',
+            post={'post_id': str(victim(orphan=True))})),
+        ("POST /_admin/tasks/reapcomments", lambda i: dict(
+            path='/_admin/tasks/reapcomments', method='POST', post={})),
+        ("POST /_admin/tasks/index", lambda i: dict(
+            path='/_admin/tasks/index', method='POST', post={'ids': ",".join(
+                str(pick(i + j)[0]) for j in range(10))})),
+        ("POST /_admin/search/rebuild", lambda i: dict(
+            path='/_admin/search/rebuild', method='POST',
+            post={'phase': 'entries'})),
+        ("POST /_admin/backfill/likes", lambda i: dict(
+            path='/_admin/backfill/likes', method='POST', post={})),
+        ("POST /_admin/backfill/users", lambda i: dict(
+            path='/_admin/backfill/users', method='POST', post={})),
+        ("POST /_admin/backfill/paths", lambda i: dict(
+            path='/_admin/backfill/paths', method='POST', post={})),
+        ("POST /_admin/backfill/bodies", lambda i: dict(
+            path='/_admin/backfill/bodies', method='POST', post={})),
+        ("POST /_admin/repair/comments", lambda i: dict(
+            path='/_admin/repair/comments', method='POST', post={})),
+        ("POST /_admin/repair/users", lambda i: dict(
+            path='/_admin/repair/users', method='POST', post={})),
+        # Last, as the keys it adds retire the one the sessions are signed
+        # with once the keyring is reloaded.
+        ("GET /_admin/rotatekey", lambda i: dict(path='/_admin/rotatekey')),
+    ]
+
+    failed = 0
+    for name, spec in routes:
+        specs = [spec(i) for i in range(args.n)]
+        samples, rpcs, errors, elapsed = drive(main, specs, args.clients)
+        report(name, samples, throughput=len(samples) / max(elapsed, 1e-9),
+               rpcs=float(sum(rpcs)) / max(len(rpcs), 1), errors=errors)
+        print("%-28s %.0f requests/s, %.1f datastore RPCs per request%s" % (
+            "", RESULTS[name]["throughput"], RESULTS[name]["rpcs"],
+            errors and ", %d server errors" % errors or ""))
+        failed += errors
+    if failed:
+        print("FAIL: %d requests failed with a server error" % failed)
+        sys.exit(1)
+
+
+SCENARIOS = {
+    'accounts': bench_accounts,
+    'activity': bench_activity,
+    'bodies': bench_bodies,
+    'bulk': bench_bulk,
+    'coldstart': bench_coldstart,
+    'delete': bench_delete,
+    'fragments': bench_fragments,
+    'search': bench_search,
+    'session': bench_session,
+    'signing': bench_signing,
+    'stream': bench_stream,
+    'thread': bench_thread,
+    'likes': bench_likes,
+    'pages': bench_pages,
+    'postpage': bench_postpage,
+    'profile': bench_profile,
+    'ratelimit': bench_ratelimit,
+    'revisions': bench_revisions,
+    'routes': bench_routes,
+    'writes': bench_writes,
+}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenario', choices=sorted(SCENARIOS))
+    parser.add_argument('-n', type=int, default=50,
+                        help='number of operations per measurement')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds added to every datastore call')
+    parser.add_argument('--require-indexes', action='store_true',
+                        help='fail queries not covered by index.yaml')
+    parser.add_argument('--users', type=int, default=20,
+                        help='users seeded for the routes scenario')
+    parser.add_argument('--posts', type=int, default=100,
+                        help='posts seeded for the routes scenario')
+    parser.add_argument('--comments', type=int, default=5,
+                        help='comments seeded on each post')
+    parser.add_argument('--likes', type=int, default=5,
+                        help='likes seeded on each post')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='concurrent clients in the routes scenario')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline',
+                        help='compare with results saved by an earlier run')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='p99 slowdown counted as a regression')
+    args = parser.parse_args(argv)
+
+    setup_stubs(args.latency, args.require_indexes)
+    import main as app_main
+    # The other scenarios make more requests than the limits allow.
+    app_main.limiter.enabled = args.scenario == 'ratelimit'
+    random.seed(0)
+    SCENARIOS[args.scenario](app_main, args)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({"scenario": args.scenario, "args": vars(args),
+                       "finished": datetime.datetime.utcnow().isoformat(),
+                       "results": RESULTS}, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["results"]
+        print("")
+        print("Compared with %s:" % args.baseline)
+        regressions = compare(baseline, args.tolerance)
+        if regressions:
+            print("%d regressions" % regressions)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
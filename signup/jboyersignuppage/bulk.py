@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+#
+# Bulk export and import of the blog's users and entries as newline-delimited
+# JSON, run against the App Engine SDK's local datastore stub, so the SDK must
+# be on the python path. Run from this directory:
+#
+#     python bulk.py export --datastore blog.sqlite backup.jsonl
+#     python bulk.py import --datastore blog.sqlite backup.jsonl
+#
+# Each line holds one entity: {"kind": ..., "key": [path], "properties": {}}.
+# Entries are written with their whole text, read from their EntryBody when
+# it is long, and are imported through main.set_article(). Users are imported
+# with the UniqueEmail claim on their address. Edit history, likes, search
+# documents and per-user totals are not carried over; the /_admin repair and
+# rebuild jobs recompute the last three after an import. Imported entries get
+# the time of the import as their modified time.
+#
+# Both directions work a batch at a time and hold one batch in memory, so
+# memory use does not grow with the size of the data. Progress is saved in
+# <file>.progress after every batch; running the same command again after an
+# interruption carries on from there, and --restart starts over.
+#
+
+import argparse
+import datetime
+import json
+import os
+import sys
+import time
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+BATCH_SIZE = 500
+
+# Kinds exported, in order.
+KINDS = ['Users', 'Entry']
+
+# Entry properties not exported. The text is written whole as "article"
+# instead, and revision_count would point at revisions that are not.
+ENTRY_SKIP = frozenset(['article', 'excerpt', 'body_length',
+                        'revision_count'])
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+# Activate the datastore stub, keeping the data in datastore_file if given,
+# and return the application module.
+def setup(datastore_file=None):
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(datastore_file=datastore_file,
+                               use_sqlite=datastore_file is not None,
+                               root_path=os.path.dirname(__file__) or '.')
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(__file__) or '.')
+    import main
+    return main
+
+
+# Progress of an interrupted run, kept next to the file being read or written.
+class Progress():
+    def __init__(self, path, command):
+        self.path = path + ".progress"
+        self.command = command
+
+    # Return the saved state, or None if there is none for this command.
+    def load(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            state = json.load(f)
+        return state if state.get("command") == self.command else None
+
+    # Save state, replacing the old file only once the new one is written.
+    def save(self, state):
+        state = dict(state, command=self.command)
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.rename(self.path + ".tmp", self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def encode_value(value):
+    if isinstance(value, datetime.datetime):
+        return value.strftime(DATETIME_FORMAT)
+    return value
+
+def decode_value(prop, value):
+    if value is not None and isinstance(prop, db.DateTimeProperty):
+        return datetime.datetime.strptime(value, DATETIME_FORMAT)
+    return value
+
+
+# Return the record for an entity; text is the whole text of an entry.
+def encode(entity, text=None):
+    kind = entity.kind()
+    properties = {}
+    for name in entity.properties():
+        if kind == 'Entry' and name in ENTRY_SKIP:
+            continue
+        properties[name] = encode_value(getattr(entity, name))
+    if kind == 'Entry':
+        properties['article'] = text
+    return {"kind": kind, "key": list(entity.key().to_path()),
+            "properties": properties}
+
+
+# Return the entities to put for a record.
+def decode(main, record):
+    if record["kind"] not in KINDS:
+        raise ValueError("cannot import kind %r" % record["kind"])
+    model = getattr(main, record["kind"])
+    key = db.Key.from_path(*record["key"])
+    known = model.properties()
+    values = dict((str(name), decode_value(known[name], value))
+                  for name, value in record["properties"].items()
+                  if name in known and name != 'article')
+    entity = model(key=key, **values)
+    if record["kind"] == 'Entry':
+        return main.set_article(entity, record["properties"]["article"]
+                                or u"")[0]
+    entities = [entity]
+    # Users keyed by id have not been migrated yet; their address is
+    # claimed when they are.
+    if entity.email and key.name():
+        entities.append(main.UniqueEmail(key=main.email_key(entity.email),
+                                         user=entity.user_name))
+    return entities
+
+
+# Write the kinds to path, one entity per line, paging through each kind in
+# key order. Stops after max_batches batches if given, as if interrupted.
+# Returns the number of entities written by this run.
+def export_file(main, path, kinds=KINDS, restart=False, max_batches=None,
+                batch_size=BATCH_SIZE):
+    progress = Progress(path, "export")
+    state = None if restart else progress.load()
+    if state is None:
+        state = {"kind": kinds[0], "cursor": None, "offset": 0}
+        out = open(path, 'wb')
+    else:
+        # Drop anything written after the last saved batch.
+        out = open(path, 'r+b')
+        out.truncate(state["offset"])
+        out.seek(state["offset"])
+    written = 0
+    batches = 0
+    with out:
+        for kind in kinds[kinds.index(state["kind"]):]:
+            query = getattr(main, kind).all()
+            if kind == state["kind"] and state["cursor"]:
+                query.with_cursor(state["cursor"])
+            while max_batches is None or batches < max_batches:
+                entities = query.fetch(batch_size)
+                texts = [None] * len(entities)
+                if kind == 'Entry':
+                    texts = main.start_articles(entities)()
+                for entity, text in zip(entities, texts):
+                    out.write(json.dumps(encode(entity, text),
+                                         sort_keys=True) + "\n")
+                out.flush()
+                written += len(entities)
+                batches += 1
+                state = {"kind": kind, "cursor": query.cursor(),
+                         "offset": out.tell()}
+                if len(entities) < batch_size:
+                    break
+                progress.save(state)
+            else:
+                progress.save(state)
+                return written
+    progress.clear()
+    return written
+
+
+# Put the entities in path, a batch at a time, reserving the ids of imported
+# keys so new entities are not given them. Stops after max_batches batches if
+# given, as if interrupted. Returns the number of records read by this run.
+def import_file(main, path, restart=False, max_batches=None,
+                batch_size=BATCH_SIZE):
+    progress = Progress(path, "import")
+    state = None if restart else progress.load()
+    read = 0
+    batches = 0
+    with open(path, 'rb') as f:
+        if state:
+            f.seek(state["offset"])
+        while max_batches is None or batches < max_batches:
+            entities = []
+            ids = {}
+            # readline rather than iteration, so tell() gives the offset of
+            # the next unread line.
+            for _ in range(batch_size):
+                line = f.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                for entity in decode(main, json.loads(line)):
+                    entities.append(entity)
+                    key = entity.key()
+                    if key.id():
+                        space = (key.parent(), key.kind())
+                        ids[space] = max(ids.get(space, 0), key.id())
+                read += 1
+            if entities:
+                db.put(entities)
+            for (parent, kind), top in ids.items():
+                db.allocate_id_range(db.Key.from_path(kind, top,
+                                                      parent=parent), top, top)
+            batches += 1
+            if not line:
+                progress.clear()
+                return read
+            progress.save({"offset": f.tell()})
+    return read
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['export', 'import'])
+    parser.add_argument('file', help='newline-delimited JSON file')
+    parser.add_argument('--datastore',
+                        help='datastore file of the local development server')
+    parser.add_argument('--kinds', default=",".join(KINDS),
+                        help='kinds to export, comma separated')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--restart', action='store_true',
+                        help='ignore the progress of an interrupted run')
+    args = parser.parse_args(argv)
+
+    app_main = setup(args.datastore)
+    start = time.time()
+    if args.command == 'export':
+        kinds = [k for k in args.kinds.split(',') if k]
+        for kind in kinds:
+            if kind not in KINDS:
+                parser.error("cannot export kind %r" % kind)
+        count = export_file(app_main, args.file, kinds, args.restart,
+                            batch_size=args.batch_size)
+    else:
+        count = import_file(app_main, args.file, args.restart,
+                            batch_size=args.batch_size)
+    elapsed = time.time() - start
+    print("%sed %d entities in %.1fs (%.0f/s)" % (
+        args.command, count, elapsed, count / max(elapsed, 1e-9)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
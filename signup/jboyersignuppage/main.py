@@ -15,11 +15,37 @@ import re
 import time
 import hashlib
 import datetime
-
+import email.utils
+import json
+import base64
+import binascii
+import calendar
+import collections
+import random
+import threading
+import urllib
+import zlib
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import datastore
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.ext import db
 
+import passwords
+import revisions
+import search
+import signing
+
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), autoescape=True)
+# Compiled template bytecode is kept in memcache so that a new instance can
+# usually skip compiling the templates. Memcache is not durable: an evicted
+# template is compiled again on first use, and the warmup handler below does
+# that for all of them before an instance takes traffic.
+jinja_env = jinja2.Environment(
+    loader = jinja2.FileSystemLoader(template_dir), autoescape=True,
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        memcache.Client(), prefix='jinja2/bytecode/'))
 
 
 
@@ -37,24 +63,96 @@ jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), a
 ###############################################################################
 
 
-# Create a hash value that includes the original value along with its
-# hash. Used to verify that cookies have not been tampered with.
+# Create a signed value that includes the original value along with its
+# HMAC signature. Used to verify that cookies have not been tampered with.
 def make_secure_val(s):
-    return "%s|%s" % (s, hash_str(s))
+    return keyring.get().sign(s)
 
-# Simple hash method that creates an md5 hash from a string and a salt value
+# Simple hash method that creates an md5 hash from a string and a salt value.
+# Passwords are hashed with the passwords module; older password hashes made
+# with this are upgraded when their user logs in.
 def hash_str(s):
     return hashlib.md5(s + "secretword").hexdigest()
 
-# Method to test if a secure value and its hash are correct
+# Method to test if a signed value is correct. Returns the value, or None if
+# it is malformed or has been tampered with.
 def check_secure_val(h):
-    test=h.split('|')
-    if test[1] == make_secure_val(test[0]).split('|')[1]:
+    return keyring.get().verify(h)
+
+# Whether name cookies signed with hash_str, as logins set them before
+# sessions existed, are still accepted. The secret is not secret, so anyone
+# can forge one; leave this off unless those users must not be made to log
+# in again, and then only until they have all been back.
+LEGACY_COOKIES = False
+
+# Check a value signed with hash_str, as cookies were before they used HMAC.
+def check_legacy_val(h):
+    test = (h or "").split('|')
+    if len(test) == 2 and passwords.compare(hash_str(test[0]), str(test[1])):
         return test[0]
 
 
+# Secret for signing cookies. Key name is the key id. The newest key that
+# has become active signs new cookies; every key is accepted when checking
+# one. A new key becomes active some time after it is added so that every
+# instance has loaded it before any cookie signed with it is handed out.
+class SigningKey(db.Model):
+    secret = db.StringProperty(required = True)
+    created = db.DateTimeProperty(auto_now_add = True)
+    activates = db.DateTimeProperty(required = True)
+
+
+# Number of seconds an instance uses its copy of the signing keys before
+# loading them again, and number of keys kept when rotating.
+KEYRING_TTL = 600
+KEYRING_SIZE = 3
 
-# Database setup for the registration data.
+# Per-instance copy of the signing keys as a signing.Keyring.
+class KeyringCache():
+    def __init__(self):
+        self.keyring = None
+        self.loaded = 0
+        self.lock = threading.Lock()
+
+    def get(self):
+        if self.keyring is None or time.time() - self.loaded > KEYRING_TTL:
+            with self.lock:
+                self.keyring = self.load()
+                self.loaded = time.time()
+        return self.keyring
+
+    def load(self):
+        keys = SigningKey.all().order('-created').fetch(KEYRING_SIZE)
+        now = datetime.datetime.utcnow()
+        if not keys:
+            # Every instance starting at once agrees on the same first key.
+            keys = [SigningKey.get_or_insert('k0',
+                secret=binascii.hexlify(os.urandom(32)), activates=now)]
+        active = [k for k in keys if k.activates <= now][:1]
+        return signing.Keyring([(k.key().name(), str(k.secret))
+                                for k in active + [k for k in keys
+                                                   if k not in active]])
+
+    # Add a new key, active after delay seconds, and drop all but the newest
+    # KEYRING_SIZE keys. Returns the new key.
+    def add(self, delay=KEYRING_TTL):
+        now = datetime.datetime.utcnow()
+        key = SigningKey(key_name="k%d" % int(time.time() * 1000),
+                         secret=binascii.hexlify(os.urandom(32)),
+                         activates=now + datetime.timedelta(seconds=delay))
+        key.put()
+        old = SigningKey.all(keys_only=True).order('-created').fetch(
+            100, offset=KEYRING_SIZE)
+        db.delete([k for k in old if k != key.key()])
+        return key
+
+keyring = KeyringCache()
+
+
+
+# Database setup for the registration data. Key name is the hashed user
+# name, so a user is found with a get instead of a query. Users registered
+# before that have numeric ids until they are migrated.
 class Users(db.Model):
     user_name = db.StringProperty(required = True)
     password = db.StringProperty(required = True)
@@ -62,20 +160,260 @@ class Users(db.Model):
     created = db.DateTimeProperty(auto_now_add = True)
 
 
+# Claim on an email address, so it can only be registered once. Key name is
+# the lower-cased address; user is the key name of the Users entity.
+class UniqueEmail(db.Model):
+    user = db.StringProperty(required = True)
+
+
+# Server side login session. Key name is the session id.
+class Session(db.Model):
+    username = db.StringProperty(required = True)
+    created = db.DateTimeProperty(auto_now_add = True)
+    expires = db.DateTimeProperty(required = True)
+
+
 # Database setup for the article data.
 class Entry(db.Model):
     title = db.StringProperty(required = True)
-    article = db.TextProperty(required = True)
+    # Text of entries written before article bodies were split out; None for
+    # the others and once /_admin/backfill/bodies has moved it. Read the text
+    # with summary() or article_text(), and set it with set_article().
+    article = db.TextProperty()
+    # The whole text if it is at most EXCERPT_LENGTH characters, otherwise
+    # its start, shown on listing pages.
+    excerpt = db.TextProperty()
+    # Length of the text if it is too long for the excerpt and is kept in an
+    # EntryBody, otherwise 0.
+    body_length = db.IntegerProperty(default = 0, indexed = False)
     created = db.DateTimeProperty(auto_now_add = True)
+    # Time of the last change to the entry. Entries written before this was
+    # added have none; use last_modified() rather than reading it directly.
+    modified = db.DateTimeProperty(auto_now = True)
     author = db.StringProperty(required = True)
+    # Likes given before the like subsystem existed. Zeroed when the post is
+    # migrated; likers are now LikeMembership entities.
     like_count = db.IntegerProperty(default = 0)
-    liked_by_list = db.StringListProperty(default = "")
+    # Id of the post a comment belongs to, 0 for posts. Replies to comments
+    # have the id of the post at the top of their thread.
     parent_post = db.IntegerProperty(required = True)
+    # Id of the comment a reply answers; None for comments on the post itself.
+    reply_to = db.IntegerProperty()
+    # Materialized path of a comment: the path_segment() of each comment from
+    # the top of its thread down to this one. Sorting a post's comments by
+    # path gives thread order, and a comment's replies are the comments whose
+    # path starts with its own. None for posts.
+    path = db.StringProperty()
+    # Number of comments below this entry, replies to replies included.
+    comment_count = db.IntegerProperty(default = 0)
+    # Time of the newest comment on a post, or when it was written if it has
+    # none. Posts written before this was added have none until
+    # /_admin/repair/comments has run.
+    last_activity = db.DateTimeProperty()
+    # Number of revisions of article kept by the revisions module; 0 until
+    # the entry is first edited.
+    revision_count = db.IntegerProperty(default = 0)
+    # Number of changes made to the entry, for fragment cache keys. modified
+    # cannot serve: auto_now only sets the stored value, so a copy in memory
+    # keeps its old time after a put, and every serialization sets it anew.
+    generation = db.IntegerProperty(default = 0, indexed = False)
+
+    def last_modified(self):
+        return self.modified or self.created
+
+    # Count a change; call before putting an entry that has changed.
+    def touch(self):
+        self.generation = (self.generation or 0) + 1
+
+    # Text for listing pages: the whole text if it is short, else its start.
+    def summary(self):
+        if self.excerpt is None:
+            return make_excerpt(self.article or u"")
+        return self.excerpt
+
+    # Whether summary() leaves part of the text out.
+    def truncated(self):
+        if self.excerpt is None:
+            return len(self.article or u"") > EXCERPT_LENGTH
+        return self.body_length > 0
+
+    # Nesting level of a comment: 1 for comments on the post, 0 for posts.
+    def depth(self):
+        return (self.path or "").count('/')
+
+
+# Text of an entry too long to keep in its excerpt, zlib compressed. A child
+# of the entry with key name "body", so it is read only when the whole text
+# is shown and is written in the same transaction as the entry.
+class EntryBody(db.Model):
+    data = db.BlobProperty()
+
+# Texts longer than this many characters are kept in an EntryBody and shown
+# cut short on listing pages.
+EXCERPT_LENGTH = 500
+
+def body_key(entry_key):
+    return db.Key.from_path('EntryBody', 'body', parent=entry_key)
+
+# Start of text for listings, cut at a space or line break if there is one in
+# the second half of the first EXCERPT_LENGTH characters.
+def make_excerpt(text):
+    if len(text) <= EXCERPT_LENGTH:
+        return text
+    cut = max(text.rfind(u" ", 0, EXCERPT_LENGTH),
+              text.rfind(u"\n", 0, EXCERPT_LENGTH))
+    if cut < EXCERPT_LENGTH // 2:
+        cut = EXCERPT_LENGTH
+    return text[:cut]
+
+# Set the text of entry, which must have a complete key. Returns the entities
+# to put and the keys to delete to save it: the entry, and an EntryBody if the
+# text does not fit in the excerpt, or the old EntryBody's key if it now does.
+def set_article(entry, text):
+    had_body = entry.body_length
+    entry.article = None
+    entry.excerpt = make_excerpt(text)
+    if entry.excerpt == text:
+        entry.body_length = 0
+        return [entry], [body_key(entry.key())] if had_body else []
+    entry.body_length = len(text)
+    body = EntryBody(key=body_key(entry.key()),
+                     data=zlib.compress(text.encode('utf-8')))
+    return [entry, body], []
+
+# Whole text of entry, given its EntryBody, or None if it has none.
+def article_text(entry, body):
+    if entry.body_length and body is not None:
+        return zlib.decompress(body.data).decode('utf-8')
+    if entry.excerpt is None:
+        return entry.article or u""
+    return entry.excerpt
+
+# Start reading the bodies of those entries whose text is not all in their
+# excerpt, in one batch get. Returns a function that waits for them and
+# returns the whole text of each entry.
+def start_articles(entries):
+    long = [e for e in entries if e.body_length]
+    rpc = db.get_async([body_key(e.key()) for e in long]) if long else None
+    def finish():
+        bodies = dict(zip([e.key() for e in long],
+                          rpc.get_result() if rpc else []))
+        return [article_text(e, bodies.get(e.key())) for e in entries]
+    return finish
+
+
+# One shard of a sharded counter. Each counter is split over several root
+# entities so that concurrent increments rarely write the same entity group.
+# Key name is "<counter name>-<shard number>".
+class CounterShard(db.Model):
+    count = db.IntegerProperty(default = 0)
+
+
+# Record that a user has liked a post. Key name is "<post id>:<username>" so
+# membership can be checked with a single get and a user can only like a post
+# once.
+class LikeMembership(db.Model):
+    post_id = db.IntegerProperty(required = True)
+    username = db.StringProperty(required = True)
+    created = db.DateTimeProperty(auto_now_add = True)
+
+# Number of template output pieces joined into each chunk written by
+# Handler.render_stream.
+STREAM_BUFFER = 64
 
 # Base handler class to simplify write and render operations for other methods.
 # This class is from the Udacity Full Stack Developer Nanodegree, not created
 # by me.
 class Handler(webapp2.RequestHandler):
+    # Set stream = True on a handler to write its pages out in chunks as the
+    # template produces them, instead of building the whole page as one string.
+    stream = False
+
+    # Cache-Control header sent with pages that support conditional GETs. Each
+    # route that calls not_modified sets its own.
+    cache_control = "private, no-cache"
+
+    # Rate limits for each HTTP method, e.g. {"POST": [RateLimit(...)]}.
+    # Requests over a limit get a 429 response before the handler runs.
+    rate_limits = {}
+
+    def dispatch(self):
+        rpc_counter.reset()
+        wait = self.rate_limited()
+        if wait:
+            self.response.set_status(429)
+            self.response.headers['Retry-After'] = str(int(wait) + 1)
+            self.write("Too many requests, please try again later.")
+            return
+        webapp2.RequestHandler.dispatch(self)
+
+    # Check this request against the handler's rate limits. Returns 0 if it
+    # may go ahead, otherwise the seconds to wait. Only looks at the request
+    # itself, so it never touches the datastore: session limits are keyed on
+    # the sid cookie as sent, without checking its signature, which would
+    # need the signing keys.
+    def rate_limited(self):
+        for limit in self.rate_limits.get(self.request.method, ()):
+            identity = self.request.remote_addr
+            if limit.by == "session":
+                sid = self.request.cookies.get('sid')
+                identity = sid and "sid:" + sid or identity
+            wait = limiter.check(limit, identity)
+            if wait:
+                return wait
+        return 0
+
+    # The current user's session, loaded from the sid cookie the first time it
+    # is needed and then shared by all code handling this request. With
+    # LEGACY_COOKIES, a name cookie set by a login from before sessions
+    # existed is swapped for a session and cleared. None when the user is not
+    # logged in.
+    # RequestPipeline.start_session loads it alongside other calls instead.
+    @property
+    def session(self):
+        if not hasattr(self, '_session'):
+            self.use_session(sessions.load_sid(self.signed_cookie('sid')))
+        return self._session
+
+    # Make session, loaded for the sid cookie, the request's session.
+    def use_session(self, session):
+        self._session = session
+        name = self.request.cookies.get('name')
+        if session is None and name and LEGACY_COOKIES:
+            name = check_legacy_val(name)
+            if name:
+                self.login(name)
+                self.response.headers.add_header('Set-Cookie',
+                                                 'name=; Path=/;')
+
+    # Value of a signed cookie, or None if it is missing or was not signed by
+    # us. Each cookie is checked at most once per request.
+    def signed_cookie(self, name):
+        if not hasattr(self, '_verified'):
+            self._verified = {}
+        if name not in self._verified:
+            self._verified[name] = check_secure_val(
+                self.request.cookies.get(name))
+        return self._verified[name]
+
+    # Name of the logged in user, or "" if nobody is logged in.
+    @property
+    def username(self):
+        return self.session and self.session["username"] or ""
+
+    # Start a new session for username and send its cookie.
+    def login(self, username):
+        sid = sessions.create(username)
+        self.response.headers.add_header('Set-Cookie',
+            'sid=%s; Path=/; HttpOnly' % sessions.cookie_value(sid))
+        self._session = sessions.load(sessions.cookie_value(sid))
+
+    def logout(self):
+        sessions.delete_sid(self.signed_cookie('sid'))
+        self.response.headers.add_header('Set-Cookie', 'sid=; Path=/')
+        self.response.headers.add_header('Set-Cookie', 'name=; Path=/;')
+        self._session = None
+
     def write(self, *a, **kw):
         self.response.out.write(*a, **kw)
 
@@ -84,7 +422,41 @@ class Handler(webapp2.RequestHandler):
         return t.render(params)
 
     def render(self, template, **kw):
-        self.write(self.render_str(template, **kw))
+        if self.stream:
+            self.render_stream(template, **kw)
+        else:
+            self.write(self.render_str(template, **kw))
+
+    def render_stream(self, template, **kw):
+        t = jinja_env.get_template(template)
+        chunks = t.stream(kw)
+        chunks.enable_buffering(size=STREAM_BUFFER)
+        for chunk in chunks:
+            self.write(chunk)
+
+    # Send validators and caching headers for a page built from the values in
+    # parts (anything that changes the rendered page) and last changed at
+    # last_modified. Returns True, with a 304 response set, when the request's
+    # If-None-Match shows the client already has this version; the caller must
+    # then not render anything. If-Modified-Since alone is not enough: likes
+    # and the viewer change the page without changing last_modified.
+    def not_modified(self, parts, last_modified):
+        etag = '"%s"' % hashlib.sha1(repr(parts)).hexdigest()
+        modified = calendar.timegm(last_modified.utctimetuple())
+        self.response.headers['ETag'] = etag
+        self.response.headers['Last-Modified'] = email.utils.formatdate(
+            modified, usegmt=True)
+        self.response.headers['Cache-Control'] = self.cache_control
+        self.response.headers['Vary'] = 'Cookie'
+
+        if_none_match = self.request.headers.get('If-None-Match')
+        if not if_none_match:
+            return False
+        tags = [t.strip() for t in if_none_match.split(',')]
+        fresh = '*' in tags or etag in [t.replace('W/', '', 1) for t in tags]
+        if fresh:
+            self.response.set_status(304)
+        return fresh
 
 
 
@@ -137,21 +509,1205 @@ def blog_key(name = 'default'):
     return db.Key.from_path('blogs', name)
 
 
-# Utility class to validate user information and return a dictionary with
-# information about the user.
+# Counts the datastore RPCs made while handling the current request, so tests
+# and benchmarks can check how many round trips a page costs. Installed as an
+# API proxy hook; counts are kept per thread because requests are handled
+# concurrently.
+class RpcCounter():
+    def __init__(self):
+        self.local = threading.local()
+
+    def install(self):
+        apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+            'rpc_counter', self.hook, 'datastore_v3')
+
+    def hook(self, service, call, request, response, *args):
+        calls = self.calls()
+        calls[call] = calls.get(call, 0) + 1
+
+    def reset(self):
+        self.local.calls = {}
+
+    # Dictionary of call name (Get, RunQuery, Put, ...) to number of calls.
+    def calls(self):
+        if not hasattr(self.local, 'calls'):
+            self.local.calls = {}
+        return self.local.calls
+
+    def count(self):
+        return sum(self.calls().values())
+
+rpc_counter = RpcCounter()
+rpc_counter.install()
+
+
+# Number of posts shown on a page of the front page, and of comments shown on
+# a page of a comment thread.
+FRONT_PAGE_SIZE = 10
+COMMENT_PAGE_SIZE = 10
+
+
+# Cache for the materialized list of the most recent posts shown on the front
+# page. Every instance keeps its own copy in memory and, when a memcache style
+# backend is supplied, shares it with the other instances through it. A copy
+# held in memory is trusted for local_ttl seconds and a copy in the backend for
+# ttl seconds, so a reader never sees a list more than ttl + local_ttl seconds
+# old even if an invalidation from another instance was missed. client is a
+# function returning a memcache style client with gets and cas, used to patch
+# the shared copy; each thread makes its own, as in RateLimiter. Without one,
+# updates drop the shared copy instead.
+class FrontPageCache():
+    KEY = "frontpage"
+
+    # Drop the shared copy after this many lost cas races.
+    CAS_RETRIES = 3
+
+    def __init__(self, backend=None, ttl=60, local_ttl=5, client=None):
+        self.backend = backend
+        self.ttl = ttl
+        self.local_ttl = local_ttl
+        self.client = client
+        self.clients = threading.local()
+        self.local = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Query used to build the list when nothing usable is cached. Reads one
+    # post more than a page holds, to tell whether there is a next page.
+    def query(self):
+        return db.GqlQuery("SELECT * FROM Entry "
+                           "WHERE ANCESTOR IS :1 AND parent_post = 0 "
+                           "ORDER BY created DESC, __key__ DESC",
+                           blog_key()).fetch(FRONT_PAGE_SIZE + 1)
+
+    # Return the cached list of posts, rebuilding it on a miss.
+    def get(self):
+        now = time.time()
+        local = self.local
+        if local and now - local[0] < self.local_ttl:
+            self.count(hit=True)
+            return local[1]
+
+        if self.backend:
+            shared = self.backend.get(self.KEY)
+            if shared and now - shared[0] < self.ttl:
+                entries = [db.model_from_protobuf(pb) for pb in shared[1]]
+                self.local = (now, entries)
+                self.count(hit=True)
+                return entries
+
+        self.count(hit=False)
+        entries = self.query()
+        self.store(entries)
+        return entries
+
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def store(self, entries, built=None):
+        built = built or time.time()
+        with self.lock:
+            self.local = (built, entries)
+        if self.backend:
+            self.backend.set(self.KEY,
+                (built, [db.model_to_protobuf(e).Encode() for e in entries]),
+                time=self.ttl)
+
+    # Replace a post in the cached lists with its updated copy, keeping the
+    # time each list was built so the staleness bound is not extended. Posts
+    # that are not on the front page are ignored.
+    def update(self, entry):
+        key = entry.key()
+        with self.lock:
+            local = self.local
+            if local:
+                self.local = (local[0], [entry if e.key() == key else e
+                                         for e in local[1]])
+        if self.backend:
+            self.update_shared(entry)
+
+    # Patch the shared copy with gets and cas, so that two instances updating
+    # it at once cannot each write back a list missing the other's change.
+    def update_shared(self, entry):
+        key = entry.key()
+        if self.client:
+            client = getattr(self.clients, 'client', None)
+            if client is None:
+                client = self.clients.client = self.client()
+            for _ in range(self.CAS_RETRIES):
+                shared = client.gets(self.KEY)
+                if not shared:
+                    return
+                entries = [db.model_from_protobuf(pb) for pb in shared[1]]
+                if key not in [e.key() for e in entries]:
+                    return
+                entries = [entry if e.key() == key else e for e in entries]
+                if client.cas(self.KEY, (shared[0],
+                        [db.model_to_protobuf(e).Encode() for e in entries]),
+                        time=self.ttl):
+                    return
+        self.backend.delete(self.KEY)
+
+    # Drop the cached list so the next read rebuilds it.
+    def invalidate(self):
+        with self.lock:
+            self.local = None
+        if self.backend:
+            self.backend.delete(self.KEY)
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits,
+                "misses": misses,
+                "hit_rate": float(hits) / total if total else 0.0,
+                }
+
+front_page_cache = FrontPageCache(backend=memcache, client=memcache.Client)
+
+
+# Record of the posts each user has written in the last few seconds. Listings
+# that may be served from a cache are merged with the reader's own recent
+# writes so that an author always sees their change on the page they are
+# redirected to, without waiting for the cache to catch up. The window must be
+# at least as long as the longest time a cached listing can be served.
+# client is a function returning a memcache style client with gets, add and
+# cas, used when a backend is given so that writes made at once by one user on
+# different instances are all kept; each thread makes its own, as in
+# RateLimiter.
+class RecentWrites():
+    # Lost cas races after which a write is stored with a plain set.
+    CAS_RETRIES = 5
+
+    def __init__(self, backend=None, window=70, client=None):
+        self.backend = backend
+        self.window = window
+        self.client = client
+        self.clients = threading.local()
+        self.local = {}
+        self.lock = threading.Lock()
+
+    def key(self, username):
+        return "recent:" + username
+
+    def load(self, username):
+        return self.start_load(username)()
+
+    # Start looking up username's recent writes. Returns a function that waits
+    # for the lookup and returns what load would.
+    def start_load(self, username):
+        if self.backend and hasattr(self.backend, 'get_multi_async'):
+            rpc = self.backend.get_multi_async([self.key(username)])
+            lookup = lambda: rpc.get_result().get(self.key(username))
+        elif self.backend:
+            lookup = lambda: self.backend.get(self.key(username))
+        else:
+            lookup = lambda: self.local.get(username)
+
+        def finish():
+            return self.fresh(lookup())
+        return finish
+
+    # The writes in the window, without any earlier write of entry_key.
+    def fresh(self, writes, entry_key=None):
+        now = time.time()
+        return [w for w in writes or [] if now - w[0] < self.window and
+                w[1] != entry_key]
+
+    # Remember that username just wrote (or deleted) entry.
+    def record(self, username, entry, deleted=False):
+        if not username:
+            return
+        write = (time.time(), str(entry.key()), deleted,
+                 db.model_to_protobuf(entry).Encode())
+        if not self.backend:
+            with self.lock:
+                self.local[username] = self.fresh(self.local.get(username),
+                                                  write[1]) + [write]
+            return
+        key = self.key(username)
+        if self.client:
+            client = getattr(self.clients, 'client', None)
+            if client is None:
+                client = self.clients.client = self.client()
+            for _ in range(self.CAS_RETRIES):
+                stored = client.gets(key)
+                writes = self.fresh(stored, write[1]) + [write]
+                if stored is None:
+                    if client.add(key, writes, time=self.window):
+                        return
+                elif client.cas(key, writes, time=self.window):
+                    return
+        writes = self.fresh(self.backend.get(key), write[1]) + [write]
+        self.backend.set(key, writes, time=self.window)
+
+    # Return entries with the user's recent writes applied: deleted posts are
+    # dropped, edited posts replaced and new posts with the given parent_post
+    # added in created order, keeping at most limit entries.
+    def overlay(self, username, entries, parent_post=0,
+                limit=FRONT_PAGE_SIZE, writes=None):
+        if writes is None:
+            writes = username and self.load(username)
+        if not writes:
+            return entries
+        changed = {}
+        for w in writes:
+            changed[w[1]] = None if w[2] else db.model_from_protobuf(w[3])
+        merged = []
+        for e in entries:
+            key = str(e.key())
+            if key in changed:
+                if changed[key] is not None:
+                    merged.append(changed.pop(key))
+                else:
+                    changed.pop(key)
+            else:
+                merged.append(e)
+        for e in changed.values():
+            if e is not None and e.parent_post == parent_post:
+                merged.append(e)
+        merged.sort(key=lambda e: (e.created, e.key().id()), reverse=True)
+        return merged[:limit]
+
+recent_writes = RecentWrites(backend=memcache.Client(),
+                             client=memcache.Client)
+
+
+# Counter split over a number of CounterShard entities. Increments pick a
+# random shard and must run inside a transaction; totals are summed from a
+# batch get of every shard and cached in memcache, where increments are
+# applied after commit.
+class ShardedCounter():
+    def __init__(self, shards=20, cache_time=60):
+        self.shards = shards
+        self.cache_time = cache_time
+
+    def shard_keys(self, name):
+        return [db.Key.from_path('CounterShard', "%s-%d" % (name, i))
+                for i in range(self.shards)]
+
+    def cache_key(self, name):
+        return "counter:" + name
+
+    # Add delta to the named counter. Must be called inside a transaction.
+    def increment_in_txn(self, name, delta):
+        key_name = "%s-%d" % (name, random.randint(0, self.shards - 1))
+        shard = CounterShard.get_by_key_name(key_name)
+        if shard is None:
+            shard = CounterShard(key_name=key_name)
+        shard.count += delta
+        shard.put()
+
+    # Apply a committed increment to the cached total, if there is one.
+    def increment_cached(self, name, delta):
+        if delta >= 0:
+            memcache.incr(self.cache_key(name), delta)
+        else:
+            memcache.decr(self.cache_key(name), -delta)
+
+    # Split names into a dictionary of the totals found in memcache and a list
+    # of the names whose shards have to be read.
+    def cached(self, names):
+        names = list(set(names))
+        cached = memcache.get_multi([self.cache_key(n) for n in names])
+        totals = {}
+        missing = []
+        for name in names:
+            if self.cache_key(name) in cached:
+                totals[name] = cached[self.cache_key(name)]
+            else:
+                missing.append(name)
+        return totals, missing
+
+    # Sum the shards fetched for names (in shard_keys order, one group per
+    # name) and cache the totals.
+    def totals_from_shards(self, names, shards):
+        totals = {}
+        for i, name in enumerate(names):
+            group = shards[i * self.shards:(i + 1) * self.shards]
+            totals[name] = sum(shard.count for shard in group if shard)
+        if totals:
+            memcache.set_multi(dict((self.cache_key(n), c)
+                                    for n, c in totals.items()),
+                               time=self.cache_time)
+        return totals
+
+    # Return a dictionary of name to total for each name.
+    def counts(self, names):
+        totals, missing = self.cached(names)
+        if missing:
+            keys = []
+            for name in missing:
+                keys.extend(self.shard_keys(name))
+            totals.update(self.totals_from_shards(missing, db.get(keys)))
+        return totals
+
+    def count(self, name):
+        return self.counts([name])[name]
+
+counters = ShardedCounter()
+
+
+# Totals kept for each user: the posts and comments they have written and the
+# likes their posts and comments have received. Each is a sharded counter
+# named "user-<stat>:<username>", so they are updated by the writes that
+# change them instead of being counted when a profile is shown. As with
+# ShardedCounter, increment_in_txn runs inside the write's transaction and
+# increment_cached after it commits.
+class UserStats():
+    STATS = ("posts", "comments", "likes")
+
+    def __init__(self, counter):
+        self.counter = counter
+
+    def name(self, stat, username):
+        return "user-%s:%s" % (stat, username)
+
+    def increment_in_txn(self, stat, username, delta):
+        self.counter.increment_in_txn(self.name(stat, username), delta)
+
+    def increment_cached(self, stat, username, delta):
+        self.counter.increment_cached(self.name(stat, username), delta)
+
+    # Return a dictionary of stat to total for username.
+    def get(self, username):
+        totals = self.counter.counts([self.name(s, username)
+                                      for s in self.STATS])
+        return dict((s, totals[self.name(s, username)]) for s in self.STATS)
+
+# Users' totals change far less often than post likes, so fewer shards.
+user_stats = UserStats(ShardedCounter(shards=4))
+
+
+# Like subsystem. A like is a LikeMembership entity for the (post, user) pair
+# plus an increment of the post's sharded counter, written together in one
+# cross-group transaction so neither can be lost or double counted under
+# concurrent requests. Posts written before this existed keep their likes in
+# Entry.like_count/liked_by_list until they are migrated; displayed totals
+# add the two together.
+class LikeCounter():
+    def counter_name(self, post_id):
+        return "likes-%d" % post_id
+
+    def membership_key(self, post_id, username):
+        return db.Key.from_path('LikeMembership', "%d:%s" % (post_id,
+                                                             username))
+
+    # Move the likes recorded in a legacy entity's liked_by_list property onto
+    # membership records and the sharded counter, and strip the list from the
+    # stored entity. The Entry model no longer declares the property, so this
+    # works on the raw entities. Takes a list of keys, is safe to run more
+    # than once and returns the ids of the posts that were migrated. Callers
+    # holding a loaded copy of a migrated post must not put it back, or the
+    # old like_count is written again; load a fresh copy instead.
+    def migrate(self, keys):
+        raws = [raw for raw in datastore.Get(keys)
+                if raw is not None and 'liked_by_list' in raw]
+        if not raws:
+            return []
+        memberships = []
+        for raw in raws:
+            post_id = raw.key().id()
+            memberships.extend(
+                LikeMembership(key=self.membership_key(post_id, username),
+                               post_id=post_id, username=username)
+                for username in set(raw['liked_by_list']) if username)
+        db.put(memberships)
+
+        def txn(key):
+            raw = datastore.Get(key)
+            if 'liked_by_list' not in raw:
+                return 0
+            moved = raw.get('like_count') or 0
+            self.counter_increment(key.id(), moved)
+            raw['like_count'] = 0
+            del raw['liked_by_list']
+            datastore.Put(raw)
+            return moved
+
+        migrated = []
+        for raw in raws:
+            post_id = raw.key().id()
+            moved = db.run_in_transaction_options(
+                db.create_transaction_options(xg=True), txn, raw.key())
+            if moved:
+                counters.increment_cached(self.counter_name(post_id), moved)
+            migrated.append(post_id)
+        return migrated
+
+    def counter_increment(self, post_id, delta):
+        counters.increment_in_txn(self.counter_name(post_id), delta)
+
+    # Record that username likes post_id, which author wrote. Returns False
+    # if they already did.
+    def like(self, post_id, username, author=None):
+        def txn():
+            key = self.membership_key(post_id, username)
+            if db.get(key):
+                return False
+            LikeMembership(key=key, post_id=post_id,
+                           username=username).put()
+            self.counter_increment(post_id, 1)
+            if author:
+                user_stats.increment_in_txn("likes", author, 1)
+            return True
+        liked = db.run_in_transaction_options(
+            db.create_transaction_options(xg=True), txn)
+        if liked:
+            counters.increment_cached(self.counter_name(post_id), 1)
+            if author:
+                user_stats.increment_cached("likes", author, 1)
+        return liked
+
+    # Remove username's like from post_id, which author wrote. Returns False
+    # if there was none.
+    def unlike(self, post_id, username, author=None):
+        def txn():
+            key = self.membership_key(post_id, username)
+            if not db.get(key):
+                return False
+            db.delete(key)
+            self.counter_increment(post_id, -1)
+            if author:
+                user_stats.increment_in_txn("likes", author, -1)
+            return True
+        unliked = db.run_in_transaction_options(
+            db.create_transaction_options(xg=True), txn)
+        if unliked:
+            counters.increment_cached(self.counter_name(post_id), -1)
+            if author:
+                user_stats.increment_cached("likes", author, -1)
+        return unliked
+
+    # Return the set of the given post ids that username has liked, using one
+    # batch get of the membership keys.
+    def liked_by(self, username, post_ids):
+        if not username:
+            return set()
+        post_ids = list(post_ids)
+        found = db.get([self.membership_key(post_id, username)
+                        for post_id in post_ids])
+        return set(post_id for post_id, m in zip(post_ids, found) if m)
+
+    # Return a dictionary of post id to like count for a list of entries.
+    def counts(self, entries):
+        return self.page_state(entries)[0]
+
+    # Return (counts, liked) for a page of entries: a dictionary of post id to
+    # like count and the set of those posts username has liked. Counter shards
+    # missing from memcache and the membership records are read together in
+    # one batch get.
+    def page_state(self, entries, username=None):
+        entries = [e for e in entries if e]
+        post_ids = [e.key().id() for e in entries]
+        totals, missing = counters.cached([self.counter_name(post_id)
+                                           for post_id in post_ids])
+        keys = []
+        for name in missing:
+            keys.extend(counters.shard_keys(name))
+        shard_count = len(keys)
+        if username:
+            keys.extend(self.membership_key(post_id, username)
+                        for post_id in post_ids)
+        found = db.get(keys) if keys else []
+        totals.update(counters.totals_from_shards(missing,
+                                                  found[:shard_count]))
+        liked = set(post_id for post_id, m in zip(post_ids,
+                                                  found[shard_count:]) if m)
+        counts = dict((e.key().id(),
+                       totals[self.counter_name(e.key().id())] + e.like_count)
+                      for e in entries)
+        return counts, liked
+
+likes = LikeCounter()
+
+
+# Page cursors are opaque to the browser. Each one holds the direction to page
+# in ("n" for older entries, "p" for newer ones), and the time the page is
+# ordered by (created, or last_activity), in microseconds, and the id of the
+# entry at the edge of the current page. Entries with the same time are
+# ordered by key, so the id places the edge among them.
+def encode_cursor(direction, created, entry_id):
+    micros = (calendar.timegm(created.utctimetuple()) * 1000000 +
+              created.microsecond)
+    return base64.urlsafe_b64encode("%s:%d:%d" % (direction, micros,
+                                                  entry_id))
+
+# Returns (direction, created, key) for a cursor, or None if it is malformed.
+def decode_cursor(cursor):
+    try:
+        direction, micros, entry_id = base64.urlsafe_b64decode(
+            str(cursor)).split(":")
+        created = (datetime.datetime(1970, 1, 1) +
+                   datetime.timedelta(microseconds=int(micros)))
+        key = db.Key.from_path('Entry', int(entry_id), parent=blog_key())
+    except (TypeError, ValueError, db.BadArgumentError):
+        return None
+    if direction not in ("n", "p"):
+        return None
+    return direction, created, key
+
+
+# Fetch one page of the entries with the given parent_post, newest first by
+# the order property: created, or last_activity for the most active posts,
+# then by key. With author, only that user's entries are listed, and
+# parent_post may be None to list their posts and comments together. Paging
+# is keyset based: a page starts from the time and key stored in the cursor
+# instead of skipping over earlier rows, so every page costs the same however
+# deep it is. Returns
+# (entries, prev_cursor, next_cursor); a cursor is None when there is nothing
+# to page to in that direction.
+def fetch_page(parent_post, cursor=None, size=FRONT_PAGE_SIZE,
+               order='created', author=None):
+    return start_page(parent_post, cursor, size, order, author)()
+
+# Start the query for a page without waiting for it. Returns a function that
+# waits for the results and returns what fetch_page would.
+def start_page(parent_post, cursor=None, size=FRONT_PAGE_SIZE,
+               order='created', author=None):
+    position = cursor and decode_cursor(cursor)
+
+    def listing():
+        query = db.Query(Entry).ancestor(blog_key())
+        if author is not None:
+            query.filter('author =', author)
+        if parent_post is not None:
+            query.filter('parent_post =', parent_post)
+        return query
+
+    # The datastore has no OR, so a page after a cursor is read with two
+    # queries run together: the rest of the entries sharing the edge's time,
+    # by key, then the entries past that time.
+    if not position:
+        queries = [listing().order('-' + order).order('-__key__')]
+    elif position[0] == "n":
+        queries = [listing().filter(order + ' =', position[1])
+                            .filter('__key__ <', position[2])
+                            .order('-__key__'),
+                   listing().filter(order + ' <', position[1])
+                            .order('-' + order).order('-__key__')]
+    else:
+        queries = [listing().filter(order + ' =', position[1])
+                            .filter('__key__ >', position[2])
+                            .order('__key__'),
+                   listing().filter(order + ' >', position[1])
+                            .order(order).order('__key__')]
+    # One row more than the page holds shows whether there is another page.
+    results = [query.run(limit=size + 1, batch_size=size + 1)
+               for query in queries]
+
+    def finish():
+        entries = []
+        for rows in results:
+            entries.extend(rows)
+        more = len(entries) > size
+        entries = entries[:size]
+        if not position:
+            return page_cursors(entries, False, more, order)
+        elif position[0] == "n":
+            return page_cursors(entries, True, more, order)
+        entries.reverse()
+        return page_cursors(entries, more, True, order)
+    return finish
+
+# Build the (entries, prev_cursor, next_cursor) tuple for a page ordered by
+# the order property.
+def page_cursors(entries, more_before, more_after, order='created'):
+    prev_cursor = next_cursor = None
+    if entries and more_before:
+        prev_cursor = encode_cursor("p", getattr(entries[0], order),
+                                    entries[0].key().id())
+    if entries and more_after:
+        next_cursor = encode_cursor("n", getattr(entries[-1], order),
+                                    entries[-1].key().id())
+    return entries, prev_cursor, next_cursor
+
+
+# Replies to comments deeper than this are added next to their parent instead
+# of below it, so paths stay within the size of a StringProperty.
+MAX_THREAD_DEPTH = 8
+
+# Path segment for a comment: its created time in microseconds, then its id,
+# both fixed width hex so that segments sort in the order comments were made.
+def path_segment(created, entry_id):
+    micros = (calendar.timegm(created.utctimetuple()) * 1000000 +
+              created.microsecond)
+    return "%014x%014x/" % (micros, entry_id)
+
+# Ids of the comments on a path, from the top of the thread down.
+def path_ids(path):
+    return [int(segment[14:], 16) for segment in path.split('/')[:-1]]
+
+# Thread cursors hold the direction to page in and the path of the comment at
+# the edge of the current page.
+def encode_thread_cursor(direction, path):
+    return base64.urlsafe_b64encode("%s:%s" % (direction, path))
+
+def decode_thread_cursor(cursor):
+    try:
+        direction, path = base64.urlsafe_b64decode(str(cursor)).split(":", 1)
+    except (TypeError, ValueError):
+        return None
+    if direction not in ("n", "p"):
+        return None
+    return direction, path
+
+# Start the query for a page of a post's comments in thread order, or with
+# within set to a comment's path, of the replies below that comment. One
+# indexed query on path whatever the depth of the thread. Returns a function
+# that waits for the results and returns (entries, prev_cursor, next_cursor).
+def start_thread(post_id, cursor=None, size=COMMENT_PAGE_SIZE, within=""):
+    position = cursor and decode_thread_cursor(cursor)
+    query = db.Query(Entry).ancestor(blog_key())
+    query.filter('parent_post =', post_id)
+    if within:
+        query.filter('path >', within).filter('path <', within + u"\ufffd")
+    if not position:
+        query.order('path')
+    elif position[0] == "n":
+        query.filter('path >', position[1]).order('path')
+    else:
+        query.filter('path <', position[1]).order('-path')
+    # One row more than the page holds shows whether there is another page.
+    results = query.run(limit=size + 1, batch_size=min(size + 1, 1000))
+
+    def finish():
+        entries = list(results)
+        more = len(entries) > size
+        entries = entries[:size]
+        if not position:
+            more_before, more_after = False, more
+        elif position[0] == "n":
+            more_before, more_after = True, more
+        else:
+            entries.reverse()
+            more_before, more_after = more, True
+        prev_cursor = next_cursor = None
+        if entries and more_before:
+            prev_cursor = encode_thread_cursor("p", entries[0].path)
+        if entries and more_after:
+            next_cursor = encode_thread_cursor("n", entries[-1].path)
+        return entries, prev_cursor, next_cursor
+    return finish
+
+# Arrange views of comments, in thread order, into trees: each view's
+# children are the replies that follow it. A reply whose parent is not in the
+# list, because it is on an earlier page, becomes a root. Runs in linear time.
+# Returns the roots.
+def build_thread(views):
+    roots = []
+    stack = []
+    for view in views:
+        while stack and not view.path.startswith(stack[-1].path):
+            stack.pop()
+        (stack[-1].children if stack else roots).append(view)
+        stack.append(view)
+    return roots
+
+# Add a comment by author to post post_id, as a reply to comment reply_to if
+# it is given. The comment counts of the post and of every comment above the
+# new one, and the post's last_activity, are updated in the same transaction.
+# Returns the new comment, or None if the post does not exist.
+def add_comment(post_id, reply_to, title, article, author):
+    start = db.allocate_ids(db.Key.from_path('Entry', 1,
+                                             parent=blog_key()), 1)[0]
+    key = db.Key.from_path('Entry', start, parent=blog_key())
+
+    def txn():
+        root, parent = db.get([
+            db.Key.from_path('Entry', post_id, parent=blog_key()),
+            db.Key.from_path('Entry', reply_to or post_id,
+                             parent=blog_key())])
+        if root is None:
+            return None, None
+        path = ""
+        if parent is not None and parent.parent_post == post_id:
+            path = parent.path or ""
+        segments = path.split('/')[:-1][:MAX_THREAD_DEPTH - 1]
+        path = "".join(segment + "/" for segment in segments)
+        ids = path_ids(path)
+        above = [e for e in db.get([db.Key.from_path('Entry', i,
+                                                     parent=blog_key())
+                                    for i in ids]) if e is not None]
+        created = datetime.datetime.utcnow()
+        comment = Entry(key=key, title=title, author=author,
+                        created=created, parent_post=post_id,
+                        reply_to=ids[-1] if ids else None,
+                        path=path + path_segment(created, key.id()))
+        put, _ = set_article(comment, article)
+        for e in [root] + above:
+            e.comment_count = (e.comment_count or 0) + 1
+            e.touch()
+        root.last_activity = created
+        db.put(put + [root] + above)
+        user_stats.increment_in_txn("comments", author, 1)
+        return comment, root
+
+    comment, root = db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+    if root is not None:
+        user_stats.increment_cached("comments", author, 1)
+        front_page_cache.update(root)
+    return comment
+
+
+# Plain, precomputed view of an entry for the templates, so rendering never
+# touches the datastore model.
+class ArticleView():
+    def __init__(self, entry, like_count=0, liked=False):
+        self.id = entry.key().id()
+        self.title = entry.title
+        # Only the start of a long text; see show_whole().
+        self.article = entry.summary()
+        self.truncated = entry.truncated()
+        self.author = entry.author
+        self.parent_post = entry.parent_post
+        self.created = entry.created
+        self.modified = entry.last_modified()
+        self.generation = entry.generation or 0
+        self.like_count = like_count
+        self.liked = liked
+        self.path = entry.path or ""
+        self.depth = entry.depth()
+        self.comment_count = entry.comment_count or 0
+        self.revision_count = entry.revision_count or 0
+        # Views of the replies shown below this one; see build_thread().
+        self.children = []
+
+    # Formatted when it is read, so that views whose fragment is cached never
+    # format it.
+    @property
+    def date(self):
+        return self.created.date().strftime('%A, %B %d, %Y')
+
+    # Show text, the whole text from article_text(), instead of the summary.
+    def show_whole(self, text):
+        self.article = text
+        self.truncated = False
+
+    # Values that change the rendered entry, for page validators and
+    # fragment cache keys.
+    def version(self):
+        return (self.id, self.generation, self.like_count, self.liked,
+                self.comment_count, self.truncated)
+
+
+# Starts independent datastore and memcache calls for a request together and
+# waits on all of them at once, so a handler pays for the slowest call rather
+# than the sum of them. Each start_* method returns immediately; wait()
+# returns a dictionary of name to result.
+class RequestPipeline():
+    def __init__(self):
+        self.pending = []
+
+    # Register a call that has already been started. finish must block until
+    # the call is done and return its result.
+    def start(self, name, finish):
+        self.pending.append((name, finish))
+        return self
+
+    def start_post(self, name, post_id):
+        rpc = db.get_async(db.Key.from_path('Entry', int(post_id),
+                                            parent=blog_key()))
+        return self.start(name, rpc.get_result)
+
+    # Get the EntryBody of a post, or None if its text is all in the entry.
+    def start_body(self, name, post_id):
+        rpc = db.get_async(body_key(db.Key.from_path('Entry', int(post_id),
+                                                     parent=blog_key())))
+        return self.start(name, rpc.get_result)
+
+    def start_page(self, name, parent_post, cursor=None,
+                   size=FRONT_PAGE_SIZE, author=None, order='created'):
+        return self.start(name, start_page(parent_post, cursor, size,
+                                           order=order, author=author))
+
+    def start_user(self, name, username):
+        rpc = db.get_async(user_key(username))
+        return self.start(name, rpc.get_result)
+
+    def start_thread(self, name, post_id, cursor=None,
+                     size=COMMENT_PAGE_SIZE):
+        return self.start(name, start_thread(post_id, cursor, size))
+
+    # Load the session of the request handler is handling, unless it has
+    # been already; the result is its username, and handler.session and
+    # handler.username use it from then on.
+    def start_session(self, name, handler):
+        if hasattr(handler, '_session'):
+            return self.start(name, lambda: handler.username)
+        finish = sessions.start_load_sid(handler.signed_cookie('sid'))
+
+        def use():
+            handler.use_session(finish())
+            return handler.username
+        return self.start(name, use)
+
+    def wait(self):
+        results = {}
+        for name, finish in self.pending:
+            results[name] = finish()
+        self.pending = []
+        return results
+
+
+# Gathers everything a post page needs in two waves of datastore calls: the
+# root post, its body, the query for a page of its comments in thread order
+# and, given the request handler, the viewer's session run in parallel, then
+# the like counts and the viewer's likes for all of them come from one batch
+# get, alongside the bodies of any long comments.
+# Every view shows its whole text. comments is the flat list of comment views
+# and thread the same views arranged into reply trees.
+class PostPage():
+    def __init__(self, post_id, username=None, cursor=None, handler=None):
+        self.post_id = int(post_id)
+        self.username = username
+        self.cursor = cursor
+        self.handler = handler
+
+    # Returns False if the post does not exist.
+    def assemble(self):
+        pipeline = (RequestPipeline()
+                    .start_thread("comments", self.post_id, self.cursor,
+                                  COMMENT_PAGE_SIZE)
+                    .start_post("post", self.post_id)
+                    .start_body("body", self.post_id))
+        if self.handler:
+            pipeline.start_session("username", self.handler)
+        results = pipeline.wait()
+        if self.handler:
+            self.username = results["username"]
+        comments, self.prev_cursor, self.next_cursor = results["comments"]
+        self.entry = results["post"]
+        if self.entry is None:
+            return False
+        finish = start_articles(comments)
+        counts, liked = likes.page_state([self.entry] + comments,
+                                         self.username)
+        views = [ArticleView(e, counts[e.key().id()], e.key().id() in liked)
+                 for e in [self.entry] + comments]
+        texts = [article_text(self.entry, results["body"])] + finish()
+        for view, text in zip(views, texts):
+            view.show_whole(text)
+        self.article = views[0]
+        self.comments = views[1:]
+        self.thread = build_thread(self.comments)
+        return True
+
+
+# Thread safe cache that holds at most capacity items, evicting the least
+# recently used one when it is full. With weigh, a function giving the size of
+# a value, capacity is the total size of the values held instead.
+class LRUCache():
+    def __init__(self, capacity, weigh=None):
+        self.capacity = capacity
+        self.weigh = weigh or (lambda value: 1)
+        self.size = 0
+        self.items = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            value = self.items.pop(key)
+            self.items[key] = value
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.remove(key)
+            self.items[key] = value
+            self.size += self.weigh(value)
+            while self.size > self.capacity:
+                self.size -= self.weigh(self.items.popitem(last=False)[1])
+
+    def delete(self, key):
+        with self.lock:
+            self.remove(key)
+
+    # Drop key if it is held. Call with the lock held.
+    def remove(self, key):
+        if key in self.items:
+            self.size -= self.weigh(self.items.pop(key))
+
+    def __len__(self):
+        return len(self.items)
+
+
+# Cache of the HTML for single entries rendered by the templates in
+# templates/fragments, keyed by template and the view's version(), so listing
+# pages only render the entries that have changed since they were last shown.
+# Any change to a post or comment bumps its generation, and likes and replies
+# change the other parts of the version. Holds at most capacity characters of
+# HTML per instance.
+class FragmentCache():
+    def __init__(self, capacity=4 * 1024 * 1024):
+        self.cache = LRUCache(capacity, weigh=len)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # Return a LazyFragment for each view, so a streamed page looks up or
+    # renders each entry only as it is written out.
+    def render(self, template, views):
+        return [LazyFragment(self, template, view) for view in views]
+
+    # Return the fragment for a view, rendering it if it is not cached.
+    def get(self, template, view):
+        key = (template, view.version())
+        fragment = self.cache.get(key)
+        with self.lock:
+            if fragment is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if fragment is None:
+            fragment = jinja2.Markup(
+                jinja_env.get_template(template).render(article=view))
+            self.cache.set(key, fragment)
+        return fragment
+
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        total = hits + misses
+        return {"hits": hits,
+                "misses": misses,
+                "hit_rate": float(hits) / total if total else 0.0,
+                "entries": len(self.cache),
+                "size": self.cache.size,
+                }
+
+fragment_cache = FragmentCache()
+
+
+# A fragment that is only looked up or rendered when a template writes it
+# out. Templates treat it as markup.
+class LazyFragment():
+    def __init__(self, cache, template, view):
+        self.cache = cache
+        self.template = template
+        self.view = view
+
+    def __html__(self):
+        return self.cache.get(self.template, self.view)
+
+    def __unicode__(self):
+        return self.__html__()
+
+
+# How long a login session lasts.
+SESSION_LIFETIME = datetime.timedelta(days=30)
+
+# Store for login sessions. Sessions live in the datastore; lookups are served
+# from an in-process LRU cache, then a memcache style backend shared by all
+# instances, and only go to the datastore when both miss. The cookie holds the
+# signed session id, so a forged id is rejected without any lookup. Loaded
+# sessions are dictionaries with the session's "sid", "username" and
+# "expires" time.
+#
+# A logout removes the session everywhere except from the in-process caches
+# of other instances. Those trust their copy for local_ttl seconds only, so
+# a session is refused by every instance at most local_ttl seconds after it
+# was deleted.
+class SessionStore():
+    def __init__(self, backend=None, capacity=10000, local_ttl=30):
+        self.backend = backend
+        self.local_ttl = local_ttl
+        # sid -> (time cached, session)
+        self.local = LRUCache(capacity)
+
+    def cache_key(self, sid):
+        return "session:" + sid
+
+    def cookie_value(self, sid):
+        return make_secure_val(sid)
+
+
+    def cache(self, session):
+        self.local.set(session["sid"], (time.time(), session))
+        if self.backend:
+            self.backend.set(self.cache_key(session["sid"]), session,
+                time=int(session["expires"] - time.time()))
+
+    # Create a session for username and return its id.
+    def create(self, username):
+        sid = binascii.hexlify(os.urandom(16))
+        expires = datetime.datetime.utcnow() + SESSION_LIFETIME
+        Session(key_name=sid, username=username, expires=expires).put()
+        self.cache({"sid": sid, "username": username,
+                    "expires": calendar.timegm(expires.utctimetuple())})
+        return sid
+
+    # Return the session for a sid cookie value, or None if the cookie is
+    # missing, forged or expired.
+    def load(self, cookie):
+        return self.load_sid(check_secure_val(cookie))
+
+    # Return the session for an already verified session id, or None.
+    def load_sid(self, sid):
+        return self.start_load_sid(sid)()
+
+    # Start looking up a session without waiting for it: a local miss starts
+    # the backend get straight away. Returns a function that waits and
+    # returns what load_sid would. The datastore is only read, in that
+    # function, when the backend misses too.
+    def start_load_sid(self, sid):
+        if not sid:
+            return lambda: None
+        cached = self.local.get(sid)
+        if cached and time.time() - cached[0] < self.local_ttl:
+            return lambda: self.check(sid, cached[1])
+        if self.backend and hasattr(self.backend, 'get_multi_async'):
+            rpc = self.backend.get_multi_async([self.cache_key(sid)])
+            lookup = lambda: rpc.get_result().get(self.cache_key(sid))
+        elif self.backend:
+            lookup = lambda: self.backend.get(self.cache_key(sid))
+        else:
+            lookup = lambda: None
+
+        def finish():
+            session = lookup()
+            if session:
+                self.local.set(sid, (time.time(), session))
+            return self.check(sid, session)
+        return finish
+
+    # Return session, read from the datastore if it was not cached, unless
+    # it has expired.
+    def check(self, sid, session):
+        if session is None:
+            stored = Session.get_by_key_name(sid)
+            if stored is None:
+                return None
+            session = {"sid": sid, "username": stored.username,
+                       "expires": calendar.timegm(
+                           stored.expires.utctimetuple())}
+            self.cache(session)
+        if session["expires"] < time.time():
+            self.delete_sid(sid)
+            return None
+        return session
+
+    def delete(self, cookie):
+        self.delete_sid(check_secure_val(cookie))
+
+    def delete_sid(self, sid):
+        if not sid:
+            return
+        self.local.delete(sid)
+        if self.backend:
+            self.backend.delete(self.cache_key(sid))
+        db.delete(db.Key.from_path('Session', sid))
+
+sessions = SessionStore(backend=memcache.Client())
+
+
+
+# A limit on how often one client may call a handler: a burst of up to
+# requests calls, refilling at requests per seconds after that. by is the
+# identity the limit is counted against: "ip" for the client's address, or
+# "session" for its session cookie (the address when it has none). The cookie
+# is not verified, so a client can dodge a session limit by making cookies up;
+# handlers with one also limit by address.
+RateLimit = collections.namedtuple('RateLimit', 'name requests seconds by')
+
+# Token bucket rate limiter. Buckets are kept in process, so a client that is
+# over its limit is turned away without any RPC. Requests this instance lets
+# through are also counted in a bucket shared by every instance, held in a
+# memcache style client with gets, add and cas. client is a function
+# returning one; each thread makes its own, since a client remembers the
+# values it fetched with gets for the cas that follows. Pass None to keep
+# buckets in process only.
+class RateLimiter():
+    # Give up on the shared bucket after this many lost cas races and let
+    # the request through; the local bucket still applies.
+    CAS_RETRIES = 3
+
+    def __init__(self, client=None, capacity=10000):
+        self.client = client
+        self.clients = threading.local()
+        self.buckets = LRUCache(capacity)
+        self.lock = threading.Lock()
+        self.enabled = True
+
+    def key(self, limit, identity):
+        return "rate:%s:%s" % (limit.name, identity)
+
+    # Take a token from a bucket stored as (tokens, time). Returns the new
+    # state and the seconds until a token is available, 0 if one was taken.
+    def take(self, limit, state, now):
+        rate = float(limit.requests) / limit.seconds
+        if state is None:
+            tokens = limit.requests
+        else:
+            tokens = min(limit.requests, state[0] + (now - state[1]) * rate)
+        if tokens < 1:
+            return (tokens, now), (1 - tokens) / rate
+        return (tokens - 1, now), 0
+
+    def take_local(self, key, limit, now):
+        with self.lock:
+            state, wait = self.take(limit, self.buckets.get(key), now)
+            self.buckets.set(key, state)
+        return wait
+
+    def take_shared(self, key, limit, now):
+        client = getattr(self.clients, 'client', None)
+        if client is None:
+            client = self.clients.client = self.client()
+        ttl = int(limit.seconds) + 1
+        for _ in range(self.CAS_RETRIES):
+            stored = client.gets(key)
+            state, wait = self.take(limit, stored, now)
+            if wait:
+                return wait
+            if stored is None:
+                if client.add(key, state, time=ttl):
+                    return 0
+            elif client.cas(key, state, time=ttl):
+                return 0
+        return 0
+
+    # Count a request by identity against limit. Returns 0 if it is allowed,
+    # or the number of seconds until it would be.
+    def check(self, limit, identity, now=None):
+        if not self.enabled:
+            return 0
+        now = now or time.time()
+        key = self.key(limit, identity)
+        wait = self.take_local(key, limit, now)
+        if wait or self.client is None:
+            return wait
+        wait = self.take_shared(key, limit, now)
+        if wait:
+            # Other instances have used up the bucket; empty the local copy
+            # so the next requests are turned away here.
+            with self.lock:
+                self.buckets.set(key, (0, now))
+        return wait
+
+limiter = RateLimiter(client=memcache.Client)
+
+
+# Utility class to load a post and return a dictionary with information about
+# it and the current user. username is the name of the logged in user.
 class getKey():
     def with_post_id(self, post_id,username="",limit="",query=False,sameuser=True):
-        if username and username != "":
-            key = db.Key.from_path('Entry', int(post_id),parent=blog_key())
-            data = db.get(key)
-        else:
-            self.redirect("/")
-        results = {"username": check_secure_val(username),
-                    "uid_w_key": username,
+        key = db.Key.from_path('Entry', int(post_id),parent=blog_key())
+        data = db.get(key)
+        results = {"username": username,
                     "data": data,
                     "post_id": post_id,
                     }
-        if results["username"]== data.author:
+        if data is not None and results["username"]== data.author:
             results["check_same_owner"]= True
         else:
             results["check_same_owner"]= False
@@ -173,35 +1729,97 @@ class getKey():
 
 ###############################################################################
 
+# Users registered before users were keyed by their hashed name are re-keyed
+# by /_admin/backfill/users. Set to True only on a datastore where that has
+# not finished yet: a user not found by key is then also looked for by query,
+# and signup also queries for the email address.
+LEGACY_USERS = False
+
+def user_key(uid):
+    return db.Key.from_path('Users', hash_str(uid))
+
+def email_key(email):
+    return db.Key.from_path('UniqueEmail', email.lower())
+
+# Return the Users entity for a user name, or None.
+def find_user(uid):
+    user = db.get(user_key(uid))
+    if user is None and LEGACY_USERS:
+        legacy = Users.all().filter('user_name =', hash_str(uid)).get()
+        if legacy:
+            user = migrate_user(legacy)
+    return user
+
+# Re-key a legacy Users entity by its hashed user name and claim its email.
+# The legacy entity is deleted in the same transaction, so there is never
+# more than one copy of a user.
+def migrate_user(legacy):
+    def txn():
+        existing = Users.get_by_key_name(legacy.user_name)
+        if existing:
+            db.delete(legacy.key())
+            return existing
+        user = Users(key_name=legacy.user_name, user_name=legacy.user_name,
+                     password=legacy.password, email=legacy.email,
+                     created=legacy.created)
+        entities = [user]
+        if legacy.email:
+            entities.append(UniqueEmail(key=email_key(legacy.email),
+                                        user=legacy.user_name))
+        db.put(entities)
+        db.delete(legacy.key())
+        return user
+    return db.run_in_transaction_options(
+        db.create_transaction_options(xg=True), txn)
+
+
 # Class to verify user and email have not been registered. If they are new,
 # create a new user in the database.
 class CreateUser():
     def create(self, uid="",email="",pwd=""):
-        # Check Database for existing user
-
-        # Gql does not support OR statements in the WHERE clause, need two
-        # separate queries to make sure both UID and email are not yet
-        # registered.
+        # The user name and email are both checked with one batch get of
+        # their keys, and the new user and email claim are written in the
+        # same transaction, so two concurrent signups cannot both succeed.
         response = ""
         if uid !="" and pwd!="":
-            data=db.GqlQuery("SELECT * FROM Users WHERE user_name = '" + uid + "'")
-            data2=db.GqlQuery("SELECT * FROM Users WHERE email = '" + email + "'" + "and email != ''")
-
-            # Check if UID has been registered
-            if data.get():
-                response += "User ID already exists" + str(data.get().user_name)
-
-            # Check if email has been registered
-            if data2.get():
-                response += "Email already registered" + str(data2.get().email)
-
-            # Add new user if no errors have been identified
-            if response=="":
-                # Hash and store the UID and password
-                a = Users(user_name=hash_str(uid), password = hash_str(pwd), email = email)
-                key = a.put()
-                if not key:
-                    response += "Error adding to database"
+            if LEGACY_USERS:
+                find_user(uid)
+                if email:
+                    legacy = Users.all().filter('email =', email).get()
+                    if legacy and legacy.key().name() is None:
+                        migrate_user(legacy)
+
+            def txn():
+                keys = [user_key(uid)]
+                if email:
+                    keys.append(email_key(email))
+                existing = db.get(keys)
+                errors = ""
+
+                # Check if UID has been registered
+                if existing[0]:
+                    errors += "User ID already exists. "
+
+                # Check if email has been registered
+                if email and existing[1]:
+                    errors += "Email already registered. "
+
+                # Add new user if no errors have been identified
+                if errors == "":
+                    # Hash and store the UID and password
+                    entities = [Users(key=keys[0], user_name=hash_str(uid),
+                                      password=passwords.hash_password(pwd),
+                                      email=email)]
+                    if email:
+                        entities.append(UniqueEmail(key=keys[1],
+                                                    user=hash_str(uid)))
+                    db.put(entities)
+                return errors
+            try:
+                response += db.run_in_transaction_options(
+                    db.create_transaction_options(xg=True), txn)
+            except db.TransactionFailedError:
+                response += "Error adding to database"
         else:
             response += "Error adding to database"
 
@@ -213,6 +1831,8 @@ class CreateUser():
 # validation, rejecting duplicate IDs or emails, and registering the user if
 # all requirements are satisfied.
 class SignUpHandler(Handler):
+    rate_limits = {"POST": [RateLimit("signup", 5, 3600, "ip")]}
+
     def get(self):
         self.render("signup.html", response = "")
 
@@ -240,8 +1860,8 @@ class SignUpHandler(Handler):
                                         pwd=password)
             self.render("signup.html", response = response)
         if response=="":
-            # Set a cookie with the new user ID and its hash
-            self.response.headers.add_header('Set-Cookie', 'name=%s; Path=/' % str(make_secure_val(username)))
+            # Log the new user in
+            self.login(username)
 
         # If no errors, redirect to the welcome page. Otherwise show signup
         # page and any errors.
@@ -254,39 +1874,41 @@ class SignUpHandler(Handler):
 
 # Class for validating user id
 class LoginHandler(Handler):
+    rate_limits = {"POST": [RateLimit("login", 10, 60, "ip")]}
+
     def get(self):
         # If user is already logged in, redirect them to welcome page
-        username = self.request.cookies.get('name')
-        if username and username!="":
+        if self.username:
             self.redirect("/welcome")
         else:
             self.render("login.html", response = "")
 
     def post(self):
         # Check Database for existing user
-
-        # Gql does not support OR statements in the WHERE clause, need two
-        # separate queries to make sure both UID and email are not yet
-        # registered.
-
         response = ""
         uid=self.request.get('username')
         pwd=self.request.get('password')
 
         if uid !="" and pwd!="":
 
-            # UID must be hashed because it is stored as a hash value in the
-            # database.
-            data=db.GqlQuery("SELECT * FROM Users WHERE user_name = '" + hash_str(uid) + "'")
-
-            # If there was an entry for the UID attempt to log in
-            if data.get():
-                if hash_str(uid) == data.get().user_name:
-                    if hash_str(pwd) == data.get().password:
-                        self.response.headers.add_header('Set-Cookie', 'name=%s; Path=/' % str(make_secure_val(uid)))
-                        self.redirect('/welcome')
-                    else:
-                        response += "Incorrect password"
+            # Users are keyed by their hashed UID.
+            user = find_user(uid)
+
+            # If there was an entry for the UID attempt to log in. The
+            # passwords module limits how many hashes run at once so a burst
+            # of logins cannot take all the CPU from other requests.
+            if user:
+                matches, rehash = passwords.limit.verify(pwd, user.password,
+                                                         legacy=hash_str)
+                if matches:
+                    # Upgrade old hashes now that the password is known.
+                    if rehash:
+                        user.password = passwords.hash_password(pwd)
+                        user.put()
+                    self.login(uid)
+                    self.redirect('/welcome')
+                else:
+                    response += "Incorrect password"
             else:
                 self.redirect('/signup')
         else:
@@ -300,9 +1922,8 @@ class LoginHandler(Handler):
 class LogoutHandler(Handler):
     def get(self):
         # If user is already logged in, log them out then redirect them to login page. If not logged in, automatically redirect them to the login page.
-        username = self.request.cookies.get('name')
-        if username and username != "":
-            self.response.headers.add_header('Set-Cookie', 'name=; Path=/;')
+        if self.username:
+            self.logout()
             self.response.headers.add_header('Set-Cookie', 'referrer_url=; Path=/')
         self.redirect("/login")
 
@@ -328,32 +1949,54 @@ class LogoutHandler(Handler):
 # does not exist, redirects to the signup page.
 class WelcomeHandler(Handler):
     def get(self):
-        # Get username from cookie and check that 1) the cookie exists and
-        # 2) it is not a blank value, send to login page otherwise.
-        username = self.request.cookies.get('name')
-        if username and username!="":
-            self.render("welcome.html", username = check_secure_val(username))
+        # Send to signup page if not logged in.
+        if self.username:
+            self.render("welcome.html", username = self.username)
         else:
             self.redirect('/signup')
 
 
 # Class to render the frontpage of the site
 class MainHandler(Handler):
+    stream = True
+
     def get(self, title="", article="", error="",author=""):
         # User can view the webpage if not logged in so do not require uid but
         # a value needs to be set so that main.html can display a login link if
         # no uid, or can display the username if logged in.
-        username = self.request.cookies.get('name')
         # Set cookie to enable canceled edits to return here
         self.response.headers.add_header('Set-Cookie', 'referrer_url=%s; Path=/' % self.request.url)
-        if not username:
-            username = ""
-        elif check_secure_val(username):
-            username= check_secure_val(username)
-        articles = db.GqlQuery("SELECT * FROM Entry "
-                            "WHERE parent_post = 0 "
-                            "ORDER BY created DESC LIMIT 10")
-        self.render("main.html",title=title, article=article, error=error, articles = articles,author=author, username=username)
+        cursor = self.request.get('cursor')
+        # "active" lists the posts with the newest comments first.
+        sort = self.request.get('sort')
+        pipeline = RequestPipeline().start_session("username", self)
+        if sort == "active" or cursor:
+            results = pipeline.start_page("page", 0, cursor,
+                order=sort == "active" and 'last_activity' or 'created'
+                ).wait()
+            username = results["username"]
+            articles, prev_cursor, next_cursor = results["page"]
+        else:
+            # Read the front page list from the cache while the session
+            # loads. The reader's recent writes are keyed by their name, so
+            # they are looked up once it is known.
+            # The cached list has one post more than the page, if there is
+            # one, to show whether there is a next page.
+            articles = front_page_cache.get()
+            username = pipeline.wait()["username"]
+            articles = recent_writes.overlay(username, articles,
+                limit=FRONT_PAGE_SIZE + 1)
+            articles, prev_cursor, next_cursor = page_cursors(
+                articles[:FRONT_PAGE_SIZE], False,
+                len(articles) > FRONT_PAGE_SIZE)
+        like_counts, liked = likes.page_state(articles, username)
+        views = [ArticleView(e, like_counts[e.key().id()],
+                             e.key().id() in liked)
+                 for e in articles if e.parent_post == 0]
+        fragments = fragment_cache.render("fragments/post.html", views)
+        self.render("main.html",title=title, article=article, error=error, fragments = fragments,author=author, username=username,
+                    prev_cursor=prev_cursor, next_cursor=next_cursor,
+                    sort=sort)
 
 
 
@@ -377,50 +2020,98 @@ class MainHandler(Handler):
 class NewPostHandler(Handler):
     def get(self, title="", article="", error="",author="",articles="",
         username=""):
-        # Get username from cookie and check that 1) the cookie exists and
-        # 2) it is not a blank value, send to login page otherwise.
-        username = self.request.cookies.get('name')
-        if username and username != "":
-            articles = db.GqlQuery("SELECT * FROM Entry "
-                            "WHERE parent_post = 0 "
-                            "ORDER BY created DESC LIMIT 10")
+        # Send to login page if not logged in.
+        if self.username:
+            articles = recent_writes.overlay(self.username,
+                front_page_cache.get())[:FRONT_PAGE_SIZE]
             self.render("newpost.html",title=title, article=article,
-                error=error, articles = articles, author=author, username=check_secure_val(username))
+                error=error, articles = articles, author=author, username=self.username)
         else:
             self.redirect('/login')
 
     def post(self):
         title = self.request.get("subject")
         article = self.request.get("content")
-        username = check_secure_val(self.request.cookies.get('name'))
+        username = self.username
 
-        # Get username from cookie and check that 1) the cookie exists and
-        # 2) it is not a blank value, send to login page otherwise.
-        if username and username != "":
+        # Send to login page if not logged in.
+        if username:
             if title and article:
-                a = Entry(title=title, article=article, parent=blog_key(),
-                    author=username, parent_post = 0)
-                a.put()
+                post_id = db.allocate_ids(db.Key.from_path('Entry', 1,
+                    parent=blog_key()), 1)[0]
+                a = Entry(key=db.Key.from_path('Entry', post_id,
+                    parent=blog_key()), title=title, author=username,
+                    parent_post = 0, last_activity=datetime.datetime.utcnow())
+                put, _ = set_article(a, article)
+                def txn():
+                    db.put(put)
+                    user_stats.increment_in_txn("posts", username, 1)
+                db.run_in_transaction_options(
+                    db.create_transaction_options(xg=True), txn)
+                user_stats.increment_cached("posts", username, 1)
+                index_later([a.key().id()])
+                front_page_cache.invalidate()
+                recent_writes.record(username, a)
                 self.redirect("/post/" + str(a.key().id()))
             else:
                 error = "You need to include both a title and an article"
-                self.render_front(title,article,error)
+                self.get(title=title, article=article, error=error)
         else:
-            redirect("/login")
-
-
+            self.redirect("/login")
+
+
+
+
+# Number of entries on a page of a user's profile.
+PROFILE_PAGE_SIZE = 10
+
+# Profile page for a user: their totals and their posts and comments, newest
+# first, or with ?show=posts only their posts. The listing is one query on
+# the (author, created) or (author, parent_post, created) index; the totals
+# come from user_stats.
+class UserHandler(Handler):
+    stream = True
+
+    def get(self, name):
+        show = self.request.get('show')
+        results = (RequestPipeline()
+                   .start_user("user", name)
+                   .start_page("entries", 0 if show == "posts" else None,
+                               self.request.get('cursor'),
+                               PROFILE_PAGE_SIZE, author=name)
+                   .wait())
+        user = results["user"]
+        if user is None and LEGACY_USERS:
+            user = find_user(name)
+        if user is None:
+            self.abort(404)
+        entries, prev_cursor, next_cursor = results["entries"]
+        counts, liked = likes.page_state(entries, self.username)
+        articles = [ArticleView(e, counts[e.key().id()], e.key().id() in liked)
+                    for e in entries]
+        self.render("user.html", name=name, stats=user_stats.get(name),
+                    articles=articles, show=show, prev_cursor=prev_cursor,
+                    next_cursor=next_cursor, username=self.username)
 
 
 # Class to redirect user to their new post once they create it.
 class PostHandler(Handler):
+    # New posts and edits redirect here, so the author must never be shown a
+    # copy from before their change: always revalidate.
+    cache_control = "private, no-cache"
+
     def get(self, post_id):
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        username = self.request.cookies.get('name')
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="")
+        if keyinfo["data"] is None:
+            self.abort(404)
+        like_count = likes.counts([keyinfo["data"]])[int(post_id)]
+        if self.not_modified((keyinfo["username"], int(post_id), like_count,
+                              keyinfo["data"].last_modified()),
+                             keyinfo["data"].last_modified()):
+            return
         title= keyinfo["data"].title
-        article= keyinfo["data"].article
+        article= start_articles([keyinfo["data"]])()[0]
         date= keyinfo["data"].created.date().strftime('%A, %B %d, %Y')
         author = keyinfo["data"].author
         self.render("postpermalink.html", title=title,article=article,
@@ -428,23 +2119,55 @@ class PostHandler(Handler):
 
 
 
+# Lists the stored revisions of a post or comment, newest first.
+class HistoryHandler(Handler):
+    def get(self, post_id):
+        entry = Entry.get_by_id(int(post_id), parent=blog_key())
+        if entry is None:
+            self.abort(404)
+        history = revisions.history(entry.key(), entry.revision_count)
+        self.render("history.html", entry=entry, post_id=int(post_id),
+                    history=list(enumerate(history))[::-1],
+                    username=self.username)
+
+
+# Shows the text of one revision of a post or comment.
+class RevisionHandler(Handler):
+    def get(self, post_id, number):
+        entry = Entry.get_by_id(int(post_id), parent=blog_key())
+        if entry is None:
+            self.abort(404)
+        number = int(number)
+        text = None
+        if number < entry.revision_count:
+            text = revisions.text(entry.key(), number)
+        if text is None:
+            self.abort(404)
+        self.render("revision.html", entry=entry, post_id=int(post_id),
+                    number=number, text=text,
+                    latest=number == entry.revision_count - 1,
+                    username=self.username)
+
+
 # Class to handle editing of posts
 class EditHandler(Handler):
     def get(self):
         url = self.request.url
         post_id = url.rsplit('/', 1)[-1]
-        username = self.request.cookies.get('name')
+        if not self.username:
+            self.redirect("/login")
+            return
         self.response.headers.add_header('Set-Cookie',
             'post_id=%s; Path=/' % str(post_id))
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="")
+        if keyinfo["data"] is None:
+            self.abort(404)
         # Check if current user is the author of the post and if so allow them
         # to edit the post.
         if keyinfo["username"] == keyinfo["data"].author:
             title= keyinfo["data"].title
-            article= keyinfo["data"].article
+            article= start_articles([keyinfo["data"]])()[0]
             date= keyinfo["data"].created.date().strftime('%A, %B %d, %Y')
             author = keyinfo["data"].author
 
@@ -458,15 +2181,37 @@ class EditHandler(Handler):
     def post(self):
         article = self.request.get("content")
         post_id = self.request.cookies.get('post_id')
-        username = self.request.cookies.get('name')
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="")
-        keyinfo["data"].article = article
-        keyinfo["data"].put()
-        #Sleep for one second before redirecting and updating the post
-        time.sleep(1)
+        # Only the author of the article may change it.
+        if not keyinfo["check_same_owner"]:
+            error = "Only the author of the article may edit it"
+            self.render("error.html",error=error)
+            return
+        # A cached copy of a migrated post still has its old like_count,
+        # which would be counted on top of the moved likes.
+        if likes.migrate([keyinfo["data"].key()]):
+            front_page_cache.invalidate()
+        # Save the edit to a fresh copy, so that a comment count changed by
+        # a reply since the post was loaded is not written back. The text it
+        # replaces is kept as a revision.
+        def txn():
+            entry, body = db.get([keyinfo["data"].key(),
+                                  body_key(keyinfo["data"].key())])
+            previous = article_text(entry, body)
+            if previous != article:
+                entry.revision_count = revisions.add(entry.key(),
+                    entry.revision_count, previous, article,
+                    keyinfo["username"], since=entry.last_modified())
+            put, delete = set_article(entry, article)
+            entry.touch()
+            db.put(put)
+            db.delete(delete)
+            return entry
+        keyinfo["data"] = db.run_in_transaction(txn)
+        index_later([keyinfo["data"].key().id()])
+        front_page_cache.update(keyinfo["data"])
+        recent_writes.record(keyinfo["username"], keyinfo["data"])
         self.redirect(self.request.referer)
 
 
@@ -479,150 +2224,635 @@ class EditCancelHandler(Handler):
 
 # Class for liking a post
 class LikeHandler(Handler):
+    rate_limits = {"GET": [RateLimit("like", 30, 60, "session"),
+                           RateLimit("like-ip", 120, 60, "ip")]}
+
     def get(self,post_id):
-        username = self.request.cookies.get('name')
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        if not self.username:
+            self.redirect("/login")
+            return
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="")
+        if keyinfo["data"] is None:
+            self.abort(404)
         # Cannot like a post if it is their own post
         if keyinfo["check_same_owner"]:
             error = ("You may only like or unlike posts that you did not"
                      "create")
             self.render("error.html",error=error,
-                username=check_secure_val(username))
-        # If they are not the owner, and they have not already liked the post
-        # then allow to like. Sleep for 1 second to allow update.
-        elif keyinfo["username"] not in keyinfo["data"].liked_by_list:
-            keyinfo["data"].like_count = keyinfo["data"].like_count + 1
-            keyinfo["data"].liked_by_list.append(keyinfo["username"])
-            keyinfo["data"].put()
-            time.sleep(1)
-            self.redirect(self.request.referer)
+                username=self.username)
+        # If they are not the owner, record the like. Liking a post twice has
+        # no effect.
         else:
+            if likes.migrate([keyinfo["data"].key()]):
+                front_page_cache.invalidate()
+            likes.like(int(post_id), keyinfo["username"],
+                       keyinfo["data"].author)
             self.redirect(self.request.referer)
 
 
 # Class for unliking a post
 class UnLikeHandler(Handler):
+    # Shares the like bucket, so liking and unliking in turn is limited too.
+    rate_limits = LikeHandler.rate_limits
+
     def get(self,post_id):
-        username = self.request.cookies.get('name')
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        if not self.username:
+            self.redirect("/login")
+            return
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="")
+        if keyinfo["data"] is None:
+            self.abort(404)
         # Cannot unlike a post if it is their own post
         if keyinfo["check_same_owner"]:
             error = ("You may only like or unlike posts that you did not"
                      "create")
             self.render("error.html",error=error,username=keyinfo["username"])
-        # If they are not the owner, and they have already liked the post
-        # then allow to like. Sleep for 1 second to allow update.
-        elif keyinfo["username"] in keyinfo["data"].liked_by_list:
-            if keyinfo["data"].like_count>0: # This should not matter but just
-                                  # in case a situation occurs where a user
-                                  # name is in the liked list and the count
-                                  # had not been properly decremented.
-                keyinfo["data"].like_count = keyinfo["data"].like_count - 1
-                keyinfo["data"].liked_by_list.remove(keyinfo["username"])
-                keyinfo["data"].put()
-                time.sleep(1)
-            self.redirect(self.request.referer)
+        # If they are not the owner, remove their like if they have one.
         else:
+            if likes.migrate([keyinfo["data"].key()]):
+                front_page_cache.invalidate()
+            likes.unlike(int(post_id), keyinfo["username"],
+                         keyinfo["data"].author)
             self.redirect(self.request.referer)
 
 
 
 # Class for adding comments to posts
 class CommentHandler(Handler):
+    stream = True
+    rate_limits = {"POST": [RateLimit("comment", 10, 60, "session"),
+                            RateLimit("comment-ip", 30, 60, "ip")]}
+
     def get(self, title="", article="", error="",author="" ):
-        url = self.request.url
-        post_id = url.rsplit('/', 1)[-1]
-        username = self.request.cookies.get('name')
+        post_id = self.request.path.rsplit('/', 1)[-1]
         # Set cookie to enable canceled edits to return here
         #self.response.headers.add_header('Set-Cookie', 'referrer_url=%s; Path=/' % self.request.url)
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
-            limit="")
-        mainarticle = keyinfo["data"]
-        articles = db.GqlQuery("SELECT * FROM Entry "
-                        "WHERE parent_post = " + post_id +
-                        "ORDER BY created DESC LIMIT 10")
+        # Fetch the session, the post and its comments at the same time.
+        results = (RequestPipeline()
+                   .start_session("username", self)
+                   .start_post("post", post_id)
+                   .start_page("comments", int(post_id),
+                               self.request.get('cursor'), COMMENT_PAGE_SIZE)
+                   .wait())
+        if not results["username"]:
+            self.redirect("/login")
+            return
+        mainarticle = results["post"]
+        if mainarticle is None:
+            self.abort(404)
+        articles, prev_cursor, next_cursor = results["comments"]
         self.render("comment.html",title=title, article=article, error=error,
                 articles = articles, author=author, mainarticle= mainarticle,
-                username = keyinfo["username"])
+                prev_cursor=prev_cursor, next_cursor=next_cursor,
+                reply_to=self.request.get('reply_to'),
+                username = self.username)
 
     def post(self):
         title = self.request.get("subject")
         article = self.request.get("content")
         parentid = self.request.get("parentid")
-        username = check_secure_val(self.request.cookies.get('name'))
+        reply_to = self.request.get("reply_to")
+        username = self.username
 
         # Check user login status and createa new article with the information
         # from the form.
         if username and username != "":
             if title and article:
-                a = Entry(title=title, article=article, parent=blog_key(),
-                    author=username, parent_post = int(parentid))
-                a.put()
+                a = add_comment(int(parentid),
+                                int(reply_to) if reply_to.isdigit() else None,
+                                title, article, username)
+                if a is None:
+                    self.abort(404)
+                index_later([a.key().id()])
                 self.redirect("/postcomment/" + str(parentid))
             else:
                 error = "You need to include both a title and an article"
                 self.render("error.html",error=error,
-                            username=check_secure_val(username))
+                            username=username)
         else:
-            redirect("/login")
+            self.redirect("/login")
 
 
 # Class for displaying post comments.
 class PostCommentHandler(Handler):
+    stream = True
+    # Comments and likes redirect back here and other users' comments arrive
+    # at any time, so always revalidate; the page shows the viewer's likes
+    # and name, so only their own browser may keep it.
+    cache_control = "private, no-cache"
+
     def get(self, post_id, title="", article="", error="",author="",
             username="" ):
-        username = self.request.cookies.get('name')
         # Set cookie to enable canceled edits to return here
         self.response.headers.add_header('Set-Cookie', 'referrer_url=%s;'
             'Path=/' % self.request.url)
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
-            limit="")
-        article = keyinfo["data"]
-        articles = db.GqlQuery("SELECT * FROM Entry "
-                        "WHERE parent_post = " + post_id +
-                        "ORDER BY created DESC LIMIT 10")
-        self.render("displaypost.html",title=title, article=article,
-                error=error, articles = articles, author=author,
-                rootID=post_id, username=check_secure_val(username))
+        page = PostPage(post_id, cursor=self.request.get('cursor'),
+                        handler=self)
+        if not page.assemble():
+            self.abort(404)
+        username = page.username
+        views = [page.article] + page.comments
+        if self.not_modified((username, page.prev_cursor, page.next_cursor,
+                              [v.version() for v in views]),
+                             max(v.modified for v in views)):
+            return
+        fragments = dict(zip([v.id for v in page.comments],
+            fragment_cache.render("fragments/comment.html", page.comments)))
+        self.render("displaypost.html",title=title, article=page.article,
+                error=error, articles = page.thread, author=author,
+                fragments=fragments,
+                prev_cursor=page.prev_cursor, next_cursor=page.next_cursor,
+                rootID=post_id, username=username)
 
 
 
 # Class for deleting posts
 class DeletePostHandler(Handler):
     def get(self,post_id):
-        username = self.request.cookies.get('name')
-        # Get username from cookie, validation and redirection(if needed), is
-        # handled in the getKey() class.
-        keyinfo = getKey().with_post_id(post_id=post_id,username=username,
+        if not self.username:
+            self.redirect("/login")
+            return
+        keyinfo = getKey().with_post_id(post_id=post_id,username=self.username,
             limit="", sameuser=True)
         # Make sure owner of the post is deleting it.
         if keyinfo["check_same_owner"]:
             # Even though the owner of the post may not be the owner of
             # comments to the post, the comments will be left "floating" in the
-            # database if the post is deleted, so delete all comments too.
-            articles = db.GqlQuery("SELECT * FROM Entry "
-                        "WHERE parent_post = " + post_id)
-            for article in articles:
-                article.delete()
-            # Delete the main post
-            keyinfo["data"].delete()
-            time.sleep(1)
+            # database if the post is deleted, so a task deletes them after
+            # the post is gone.
+            delete_post(keyinfo["data"])
+            front_page_cache.invalidate()
+            recent_writes.record(keyinfo["username"], keyinfo["data"],
+                                 deleted=True)
             self.redirect("/")
         else:
             error="You do not have permission to delete this post."
             self.render("error.html",error=error,username=keyinfo["username"])
 
 
+# Delete a post or comment and queue a task to delete the comments below it.
+# The task is only added if the entry is deleted, and the entry disappears
+# straight away however many comments it has. Deleting a comment takes it and
+# its replies off the comment counts of the entries above it.
+def delete_post(entry):
+    stat = "comments" if entry.parent_post else "posts"
+
+    def txn():
+        db.delete([entry.key(), body_key(entry.key())] +
+                  revisions.keys(entry.key(), entry.revision_count))
+        index_later([entry.key().id()], transactional=True)
+        user_stats.increment_in_txn(stat, entry.author, -1)
+        if not entry.parent_post:
+            params = {'post_id': entry.key().id()}
+        elif entry.path:
+            params = {'post_id': entry.parent_post, 'path': entry.path}
+            above = db.get([db.Key.from_path('Entry', i, parent=blog_key())
+                            for i in [entry.parent_post] +
+                            path_ids(entry.path)[:-1]])
+            above = [e for e in above if e is not None]
+            for e in above:
+                e.comment_count = max(0, (e.comment_count or 0) -
+                                         (entry.comment_count or 0) - 1)
+                e.touch()
+            db.put(above)
+        else:
+            return
+        taskqueue.add(url='/_admin/tasks/deletecomments', params=params,
+                      transactional=True)
+    db.run_in_transaction_options(db.create_transaction_options(xg=True), txn)
+    user_stats.increment_cached(stat, entry.author, -1)
+
+
+# Task that deletes the comments of a deleted post, or with path set the
+# replies below a deleted comment, in batches, queueing the next batch with a
+# cursor until there are none left. If a task fails it is retried from its
+# cursor.
+class DeleteCommentsHandler(Handler):
+    BATCH_SIZE = 500
+
+    def post(self):
+        post_id = int(self.request.get('post_id'))
+        path = self.request.get('path')
+        query = (db.Query(Entry).ancestor(blog_key())
+                 .filter('parent_post =', post_id))
+        if path:
+            query.filter('path >', path).filter('path <', path + u"\ufffd")
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        # Whole entities rather than keys: the author, body_length and
+        # revision_count of each comment are needed below.
+        comments = query.fetch(self.BATCH_SIZE)
+        keys = [c.key() for c in comments]
+        authors = collections.Counter(c.author for c in comments)
+        # Once the comments are deleted a retry of this task cannot see them,
+        # so a recount of their authors' totals is queued first, in case the
+        # decrements below are lost. A recount finds nothing to do when they
+        # are not.
+        if authors:
+            taskqueue.add(url='/_admin/repair/users', countdown=60,
+                          params={'author': list(authors)})
+        db.delete(keys + [body_key(c.key()) for c in comments
+                          if c.body_length] +
+                  [k for c in comments
+                   for k in revisions.keys(c.key(), c.revision_count)])
+        if keys:
+            index_later([k.id() for k in keys])
+        # Take the comments off their authors' totals.
+        for author, count in authors.items():
+            db.run_in_transaction(user_stats.increment_in_txn, "comments",
+                                  author, -count)
+            user_stats.increment_cached("comments", author, -count)
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/tasks/deletecomments',
+                          params={'post_id': post_id, 'path': path,
+                                  'cursor': query.cursor()})
+
+
+# Finds comments whose post no longer exists, left behind by deletes from
+# before DeleteCommentsHandler or by comments added while their post was being
+# deleted, and queues DeleteCommentsHandler for each such post. Run daily from
+# cron.yaml.
+class ReapCommentsHandler(Handler):
+    BATCH_SIZE = 100
+
+    def get(self):
+        taskqueue.add(url='/_admin/tasks/reapcomments')
+        self.write("Comment reaper started")
+
+    def post(self):
+        # One result per post that has comments.
+        query = db.Query(Entry, projection=('parent_post',), distinct=True)
+        query.filter('parent_post >', 0)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        post_ids = [e.parent_post for e in query.fetch(self.BATCH_SIZE)]
+        posts = db.get([db.Key.from_path('Entry', post_id, parent=blog_key())
+                        for post_id in post_ids])
+        for post_id, post in zip(post_ids, posts):
+            if post is None:
+                taskqueue.add(url='/_admin/tasks/deletecomments',
+                              params={'post_id': post_id})
+        if len(post_ids) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/tasks/reapcomments',
+                          params={'cursor': query.cursor()})
+
+
+###############################################################################
+
+#                                  Search
+
+###############################################################################
+
+
+# Queue entries to be brought up to date in the search index: entries that
+# exist are indexed again, and ones that have been deleted are removed. The
+# search queue runs one task at a time, as search.update() requires.
+def index_later(entry_ids, transactional=False):
+    taskqueue.add(url='/_admin/tasks/index', queue_name='search',
+                  params={'ids': ",".join(str(i) for i in entry_ids)},
+                  transactional=transactional)
+
+
+# Task that updates the search index for the entries queued by index_later().
+class IndexHandler(Handler):
+    BATCH_SIZE = 50
+
+    def post(self):
+        ids = [int(i) for i in self.request.get('ids').split(',') if i]
+        for start in range(0, len(ids), self.BATCH_SIZE):
+            batch = ids[start:start + self.BATCH_SIZE]
+            entries = db.get([db.Key.from_path('Entry', i, parent=blog_key())
+                              for i in batch])
+            found = [e for e in entries if e is not None]
+            texts = dict(zip([e.key().id() for e in found],
+                             start_articles(found)()))
+            search.update(dict(
+                (i, e and u"%s\n%s" % (e.title, texts[i]))
+                for i, e in zip(batch, entries)))
+
+
+# Admin-only. Rebuilds the search index from the entries that exist: every
+# entry is queued for indexing, then every indexed document whose entry is
+# gone is queued for removal. Runs as a chain of tasks like
+# BackfillLikesHandler.
+class RebuildSearchHandler(Handler):
+    BATCH_SIZE = 200
+
+    def get(self):
+        taskqueue.add(url='/_admin/search/rebuild',
+                      params={'phase': 'entries'})
+        self.write("Search index rebuild started")
+
+    def post(self):
+        phase = self.request.get('phase')
+        if phase == 'entries':
+            query = db.Query(Entry, keys_only=True).ancestor(blog_key())
+        else:
+            query = db.Query(search.SearchDoc, keys_only=True)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(self.BATCH_SIZE)
+        if phase == 'entries':
+            ids = [k.id() for k in keys]
+        else:
+            ids = [int(k.name()) for k in keys]
+            entries = db.get([db.Key.from_path('Entry', i, parent=blog_key())
+                              for i in ids])
+            ids = [i for i, e in zip(ids, entries) if e is None]
+        if ids:
+            index_later(ids)
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/search/rebuild',
+                          params={'phase': phase, 'cursor': query.cursor()})
+        elif phase == 'entries':
+            taskqueue.add(url='/_admin/search/rebuild',
+                          params={'phase': 'docs'})
+
+
+# Number of results on a page of search results.
+SEARCH_PAGE_SIZE = 10
+
+# Search page. Ranks posts and comments against the q parameter; page counts
+# from 0.
+class SearchHandler(Handler):
+    rate_limits = {"GET": [RateLimit("search", 60, 60, "ip")]}
+
+    def get(self):
+        q = self.request.get('q')
+        try:
+            page = max(0, int(self.request.get('page') or 0))
+        except ValueError:
+            page = 0
+        results = search.search(q, page, SEARCH_PAGE_SIZE)
+        entries = db.get([db.Key.from_path('Entry', doc_id, parent=blog_key())
+                          for doc_id, _ in results.hits])
+        # Entries deleted since they were found are left out until the index
+        # catches up.
+        articles = [ArticleView(e) for e in entries if e is not None]
+        prev_query = next_query = None
+        if page > 0:
+            prev_query = urllib.urlencode({'q': q.encode('utf-8'),
+                                           'page': page - 1})
+        if results.more:
+            next_query = urllib.urlencode({'q': q.encode('utf-8'),
+                                           'page': page + 1})
+        self.render("search.html", q=q, articles=articles,
+                    prev_query=prev_query, next_query=next_query,
+                    username=self.username)
+
+
+# Class to report cache hit and miss counters as JSON. Restricted to admins in
+# app.yaml.
+class CacheStatsHandler(Handler):
+    def get(self):
+        self.response.headers['Content-Type'] = 'application/json'
+        self.write(json.dumps({"frontpage": front_page_cache.stats(),
+                               "fragments": fragment_cache.stats()}))
+
+
+# Task that moves likes off legacy Entry entities (see LikeCounter.migrate) in
+# batches. A GET starts the backfill; each task processes one batch of keys
+# and queues the next one with the query cursor, so an interrupted run picks
+# up where it stopped when the task is retried.
+class BackfillLikesHandler(Handler):
+    BATCH_SIZE = 100
+
+    def get(self):
+        taskqueue.add(url='/_admin/backfill/likes')
+        self.write("Like backfill started")
+
+    def post(self):
+        query = db.Query(Entry, keys_only=True).ancestor(blog_key())
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(self.BATCH_SIZE)
+        migrated = likes.migrate(keys)
+        if migrated:
+            front_page_cache.invalidate()
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/backfill/likes',
+                          params={'cursor': query.cursor()})
+
+
+# Admin-only. Gives comments made before threading a path, as comments on
+# their post. Until then they are missing from thread order queries. Run
+# /_admin/repair/comments afterwards to count them. Runs as a chain of tasks
+# like BackfillLikesHandler.
+class BackfillPathsHandler(Handler):
+    BATCH_SIZE = 100
+
+    def get(self):
+        taskqueue.add(url='/_admin/backfill/paths')
+        self.write("Comment path backfill started")
+
+    def post(self):
+        query = Entry.all().filter('parent_post >', 0)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        comments = query.fetch(self.BATCH_SIZE)
+        keys = [c.key() for c in comments if c.path is None]
+        if keys:
+            db.run_in_transaction(self.migrate, keys)
+        if len(comments) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/backfill/paths',
+                          params={'cursor': query.cursor()})
+
+    def migrate(self, keys):
+        comments = [c for c in db.get(keys) if c is not None and c.path is None]
+        for comment in comments:
+            comment.path = path_segment(comment.created, comment.key().id())
+        db.put(comments)
+
+
+# Admin-only. Moves the text of entries written before article bodies were
+# split out into an excerpt, and an EntryBody if it is long, so listing pages
+# stop reading it. Runs as a chain of tasks like BackfillLikesHandler.
+class BackfillBodiesHandler(Handler):
+    BATCH_SIZE = 100
+
+    def get(self):
+        taskqueue.add(url='/_admin/backfill/bodies')
+        self.write("Article body backfill started")
+
+    def post(self):
+        query = Entry.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        entries = query.fetch(self.BATCH_SIZE)
+        keys = [e.key() for e in entries if e.excerpt is None]
+        if keys:
+            db.run_in_transaction(self.migrate, keys)
+        if len(entries) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/backfill/bodies',
+                          params={'cursor': query.cursor()})
+
+    def migrate(self, keys):
+        put = []
+        for entry in db.get(keys):
+            if entry is not None and entry.excerpt is None:
+                put.extend(set_article(entry, entry.article or u"")[0])
+        db.put(put)
+
+
+# Admin-only. Recomputes the comment count of every post and comment, and the
+# last_activity of every post, from the comments that exist, fixing any that
+# have drifted or were never set. Each post is recounted in a transaction so
+# comments added meanwhile are not missed. Runs as a chain of tasks like
+# BackfillLikesHandler.
+class RepairCommentsHandler(Handler):
+    BATCH_SIZE = 20
+
+    def get(self):
+        taskqueue.add(url='/_admin/repair/comments')
+        self.write("Comment count repair started")
+
+    def post(self):
+        query = (db.Query(Entry, keys_only=True).ancestor(blog_key())
+                 .filter('parent_post =', 0))
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        keys = query.fetch(self.BATCH_SIZE)
+        repaired = 0
+        for key in keys:
+            repaired += db.run_in_transaction(self.repair, key)
+        if repaired:
+            front_page_cache.invalidate()
+        if len(keys) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/repair/comments',
+                          params={'cursor': query.cursor()})
+
+    # Recount one post's thread. Returns the number of entries changed.
+    def repair(self, key):
+        post = db.get(key)
+        if post is None:
+            return 0
+        comments = list(Entry.all().ancestor(blog_key())
+                        .filter('parent_post =', key.id())
+                        .run(batch_size=1000))
+        counts = {}
+        for comment in comments:
+            for entry_id in [key.id()] + path_ids(comment.path or "")[:-1]:
+                counts[entry_id] = counts.get(entry_id, 0) + 1
+        last_activity = max([post.created] + [c.created for c in comments])
+        changed = []
+        for entry in [post] + comments:
+            count = counts.get(entry.key().id(), 0)
+            if entry.comment_count != count:
+                entry.comment_count = count
+                changed.append(entry)
+        if post.last_activity != last_activity:
+            post.last_activity = last_activity
+            if post not in changed:
+                changed.append(post)
+        for entry in changed:
+            entry.touch()
+        db.put(changed)
+        return len(changed)
+
+
+# Admin-only. Recounts every author's user_stats totals from the entries and
+# likes that exist, and corrects the counters by the difference. Puts right
+# totals missed by a failed write, and counts entries written before the
+# totals existed. Runs as a chain of tasks like BackfillLikesHandler. A task
+# given author parameters recounts only those authors.
+class RepairUsersHandler(Handler):
+    BATCH_SIZE = 20
+
+    def get(self):
+        taskqueue.add(url='/_admin/repair/users')
+        self.write("User totals repair started")
+
+    def post(self):
+        authors = self.request.get_all('author')
+        if authors:
+            for author in authors:
+                self.repair(author)
+            return
+        query = db.Query(Entry, projection=('author',), distinct=True)
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        authors = [e.author for e in query.fetch(self.BATCH_SIZE)]
+        for author in authors:
+            self.repair(author)
+        if len(authors) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/repair/users',
+                          params={'cursor': query.cursor()})
+
+    def repair(self, author):
+        entries = list(Entry.all().ancestor(blog_key())
+                       .filter('author =', author).run(batch_size=1000))
+        actual = {
+            "posts": sum(1 for e in entries if not e.parent_post),
+            "comments": sum(1 for e in entries if e.parent_post),
+            "likes": sum(likes.counts(entries).values()) if entries else 0,
+        }
+        names = [user_stats.name(stat, author) for stat in UserStats.STATS]
+        counter = user_stats.counter
+        keys = []
+        for name in names:
+            keys.extend(counter.shard_keys(name))
+        stored = counter.totals_from_shards(names, db.get(keys))
+        for stat, name in zip(UserStats.STATS, names):
+            delta = actual[stat] - stored[name]
+            if delta:
+                db.run_in_transaction(user_stats.increment_in_txn, stat,
+                                      author, delta)
+                user_stats.increment_cached(stat, author, delta)
+
+
+# Handler for App Engine warmup requests. Compiles every template before the
+# instance takes traffic, so the first request to each route does not pay for
+# it.
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        for name in jinja_env.list_templates():
+            jinja_env.get_template(name)
+
+
+# Task that re-keys Users entities registered before users were keyed by
+# their hashed name, in batches chained by query cursor like
+# BackfillLikesHandler.
+class BackfillUsersHandler(Handler):
+    BATCH_SIZE = 100
+
+    def get(self):
+        taskqueue.add(url='/_admin/backfill/users')
+        self.write("User backfill started")
+
+    def post(self):
+        query = Users.all()
+        cursor = self.request.get('cursor')
+        if cursor:
+            query.with_cursor(cursor)
+        users = query.fetch(self.BATCH_SIZE)
+        for user in users:
+            if user.key().name() is None:
+                migrate_user(user)
+        if len(users) == self.BATCH_SIZE:
+            taskqueue.add(url='/_admin/backfill/users',
+                          params={'cursor': query.cursor()})
+
+
+# Admin-only. Adds a new cookie signing key. It starts signing cookies once
+# every instance has had time to load it; the oldest key is dropped, so
+# cookies signed with it stop being accepted.
+class RotateKeyHandler(Handler):
+    def get(self):
+        key = keyring.add()
+        self.write("Added signing key %s, active from %s UTC" %
+                   (key.key().name(), key.activates))
+
+
 app = webapp2.WSGIApplication([
     ('/', MainHandler),
     ('/welcome', WelcomeHandler),
@@ -631,11 +2861,28 @@ app = webapp2.WSGIApplication([
     ('/logout', LogoutHandler),
     ('/newpost', NewPostHandler),
     (r'/post/([0-9]+)', PostHandler),
+    (r'/post/([0-9]+)/history', HistoryHandler),
+    (r'/post/([0-9]+)/rev/([0-9]+)', RevisionHandler),
     (r'/editpost/[0-9]+', EditHandler), # Parenthesis removed to avoid issue with Posting
     (r'/like/([0-9]+)', LikeHandler),
     (r'/unlike/([0-9]+)', UnLikeHandler),
     (r'/comment/[0-9]+', CommentHandler), # Parenthesis removed to avoid issue with Posting
     (r'/postcomment/([0-9]+)', PostCommentHandler),
     (r'/deletepost/([0-9]+)', DeletePostHandler),
-    ('/canceledit',EditCancelHandler)
+    ('/canceledit',EditCancelHandler),
+    ('/_stats/cache', CacheStatsHandler),
+    ('/_admin/backfill/likes', BackfillLikesHandler),
+    ('/_admin/backfill/users', BackfillUsersHandler),
+    ('/_admin/backfill/paths', BackfillPathsHandler),
+    ('/_admin/backfill/bodies', BackfillBodiesHandler),
+    ('/_admin/repair/comments', RepairCommentsHandler),
+    ('/_admin/repair/users', RepairUsersHandler),
+    ('/_admin/search/rebuild', RebuildSearchHandler),
+    ('/_admin/tasks/index', IndexHandler),
+    ('/search', SearchHandler),
+    (r'/user/([a-zA-Z0-9_-]+)', UserHandler),
+    ('/_admin/rotatekey', RotateKeyHandler),
+    ('/_admin/tasks/deletecomments', DeleteCommentsHandler),
+    ('/_admin/tasks/reapcomments', ReapCommentsHandler),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+#
+# Password hashing for the blog application.
+#
+# Passwords are stored as "pbkdf2_sha256$<iterations>$<salt>$<hash>", using a
+# random salt per password. The iteration count is the work factor; raise it
+# with calibrate() as hardware gets faster. Stored hashes with fewer
+# iterations than the current setting, and the unsalted MD5 hashes written
+# before this module existed, still verify but are reported as needing a
+# rehash so the caller can upgrade them at login.
+#
+# Run this file directly to measure hashing cost and pick an iteration count:
+#
+#     python passwords.py --budget-ms 50 --peak-rate 20
+#
+
+import argparse
+import binascii
+import hashlib
+import hmac
+import os
+import threading
+import time
+
+ALGORITHM = "pbkdf2_sha256"
+
+# Work factor for new hashes. Pick it with calibrate() on production
+# hardware.
+ITERATIONS = 10000
+
+SALT_BYTES = 16
+
+
+# PBKDF2-HMAC-SHA256. Uses the C implementation where the Python version has
+# one (2.7.8 and later). The python27 runtime's 2.7.5 has none, so there the
+# pure Python version runs, holding the GIL for the whole hash.
+if hasattr(hashlib, 'pbkdf2_hmac'):
+    def pbkdf2(password, salt, iterations):
+        return hashlib.pbkdf2_hmac('sha256', password, salt, iterations)
+else:
+    def pbkdf2(password, salt, iterations):
+        mac = hmac.new(password, digestmod=hashlib.sha256)
+
+        def prf(data):
+            h = mac.copy()
+            h.update(data)
+            return h.digest()
+        block = u = prf(salt + b'\x00\x00\x00\x01')
+        total = int(binascii.hexlify(block), 16)
+        for _ in range(iterations - 1):
+            u = prf(u)
+            total ^= int(binascii.hexlify(u), 16)
+        return binascii.unhexlify('%064x' % total)
+
+
+# Compare two strings in time that does not depend on where they differ.
+if hasattr(hmac, 'compare_digest'):
+    compare = hmac.compare_digest
+else:
+    def compare(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+def encode(password):
+    if isinstance(password, type(u'')):
+        return password.encode('utf-8')
+    return password
+
+
+# Return the stored form of password.
+def hash_password(password, iterations=None):
+    iterations = iterations or ITERATIONS
+    salt = binascii.hexlify(os.urandom(SALT_BYTES))
+    digest = binascii.hexlify(pbkdf2(encode(password), salt, iterations))
+    return "%s$%d$%s$%s" % (ALGORITHM, iterations, salt, digest)
+
+
+# Check password against a stored hash. Returns (matches, needs_rehash).
+# legacy is the function that produced hashes without an algorithm prefix.
+def verify_password(password, stored, legacy=None):
+    parts = stored.split('$')
+    if len(parts) != 4 or parts[0] != ALGORITHM:
+        if legacy is None:
+            return False, False
+        matches = compare(legacy(encode(password)), stored)
+        return matches, matches
+    try:
+        iterations = int(parts[1])
+    except ValueError:
+        return False, False
+    digest = binascii.hexlify(pbkdf2(encode(password), parts[2], iterations))
+    matches = compare(digest, parts[3])
+    return matches, matches and iterations < ITERATIONS
+
+
+# Lets at most size verifications run at once in this instance, so a burst
+# of logins queues here instead of taking all the CPU from the requests being
+# served alongside them. Verification runs on the caller's thread; another
+# thread would only add its start-up cost, as the hash holds the GIL anyway.
+class VerifyLimit(object):
+    def __init__(self, size=2):
+        self.slots = threading.BoundedSemaphore(size)
+
+    def verify(self, password, stored, legacy=None):
+        with self.slots:
+            return verify_password(password, stored, legacy)
+
+limit = VerifyLimit()
+
+
+# Return the milliseconds one hash with the given iteration count takes here.
+def measure(iterations, rounds=3):
+    best = None
+    for _ in range(rounds):
+        start = time.time()
+        pbkdf2(b'password', b'salt' * 4, iterations)
+        elapsed = (time.time() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+# Pick the largest iteration count whose hash fits the latency budget (in
+# milliseconds). With peak_rate, the logins per second at peak, the count is
+# also limited so that hashing at that rate uses no more than cpu_share of
+# one CPU.
+def calibrate(budget_ms, peak_rate=None, cpu_share=0.5, minimum=1000):
+    if peak_rate:
+        budget_ms = min(budget_ms, cpu_share * 1000.0 / peak_rate)
+    sample = 10000
+    per_iteration = measure(sample) / sample
+    iterations = int(budget_ms / per_iteration)
+    # Check the estimate and step down until it fits.
+    while iterations > minimum and measure(iterations) > budget_ms:
+        iterations = int(iterations * 0.9)
+    return max(iterations, minimum)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--budget-ms', type=float, default=50,
+                        help='largest acceptable time for one hash')
+    parser.add_argument('--peak-rate', type=float,
+                        help='logins per second at peak')
+    parser.add_argument('--cpu-share', type=float, default=0.5,
+                        help='share of one CPU logins may use at peak')
+    args = parser.parse_args()
+
+    for iterations in (1000, 10000, 50000, 100000):
+        print("%7d iterations: %8.2fms" % (iterations, measure(iterations)))
+    iterations = calibrate(args.budget_ms, args.peak_rate, args.cpu_share)
+    print("recommended ITERATIONS = %d (%.2fms per hash)" % (
+        iterations, measure(iterations)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+#
+# Edit history for the blog application.
+#
+# Each version of a text is stored as a Revision entity, a child of the
+# entity whose text it is. Revision 0 is the text before the first edit.
+# Every SNAPSHOT_EVERY-th revision holds the whole text; the others hold a
+# line diff against the revision before them. Both are zlib compressed.
+# Rebuilding a revision reads the snapshot at or before it and the diffs
+# after that in one batch get, and applies at most SNAPSHOT_EVERY - 1 diffs.
+#
+
+import difflib
+import json
+import zlib
+
+from google.appengine.ext import db
+
+SNAPSHOT_EVERY = 20
+
+
+# One version of a text. Key name is the revision number.
+class Revision(db.Model):
+    created = db.DateTimeProperty(auto_now_add = True)
+    author = db.StringProperty()
+    snapshot = db.BooleanProperty(default = False, indexed = False)
+    data = db.BlobProperty()
+    # Length of the text in characters.
+    length = db.IntegerProperty(default = 0, indexed = False)
+
+
+def revision_key(parent, number):
+    return db.Key.from_path('Revision', str(number), parent=parent)
+
+
+# Return compressed instructions for turning old into new, working a line at
+# a time: ["=", n] keeps the next n lines of old, ["-", n] drops them and
+# ["+", lines] inserts lines.
+def diff(old, new):
+    a = old.splitlines(True)
+    b = new.splitlines(True)
+    ops = []
+    matcher = difflib.SequenceMatcher(None, a, b, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append(["=", i2 - i1])
+            continue
+        if i2 > i1:
+            ops.append(["-", i2 - i1])
+        if j2 > j1:
+            ops.append(["+", b[j1:j2]])
+    return zlib.compress(json.dumps(ops).encode('utf-8'))
+
+
+# Apply the output of diff(old, new) to old and return new.
+def patch(old, data):
+    a = old.splitlines(True)
+    out = []
+    i = 0
+    for op, arg in json.loads(zlib.decompress(data).decode('utf-8')):
+        if op == "=":
+            out.extend(a[i:i + arg])
+            i += arg
+        elif op == "-":
+            i += arg
+        else:
+            out.extend(arg)
+    return u"".join(out)
+
+
+def compress(text):
+    return zlib.compress(text.encode('utf-8'))
+
+def decompress(data):
+    return zlib.decompress(data).decode('utf-8')
+
+
+# Record an edit by author of the text owned by the entity with key parent,
+# from previous to current. count is the number of revisions already stored;
+# returns the new count. The first edit also stores previous as revision 0,
+# dated since, the time it was written. Call inside the transaction that
+# saves the edit.
+def add(parent, count, previous, current, author=None, since=None):
+    put = []
+    if count == 0:
+        first = Revision(key=revision_key(parent, 0), author=author,
+                         snapshot=True, data=compress(previous),
+                         length=len(previous))
+        if since:
+            first.created = since
+        put.append(first)
+        count = 1
+    if count % SNAPSHOT_EVERY == 0:
+        data = compress(current)
+    else:
+        data = diff(previous, current)
+    put.append(Revision(key=revision_key(parent, count), author=author,
+                        snapshot=count % SNAPSHOT_EVERY == 0, data=data,
+                        length=len(current)))
+    db.put(put)
+    return count + 1
+
+
+# Return the text of revision number, or None if there is no such revision.
+def text(parent, number):
+    first = number - number % SNAPSHOT_EVERY
+    chain = db.get([revision_key(parent, n)
+                    for n in range(first, number + 1)])
+    if not chain or None in chain:
+        return None
+    result = decompress(chain[0].data)
+    for revision in chain[1:]:
+        result = patch(result, revision.data)
+    return result
+
+
+# Keys of the revisions of parent, oldest first, given their count.
+def keys(parent, count):
+    return [revision_key(parent, n) for n in range(count)]
+
+
+# Return the stored revisions of parent, oldest first, given their count.
+def history(parent, count):
+    return [r for r in db.get(keys(parent, count)) if r is not None]
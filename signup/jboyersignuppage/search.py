@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#
+# Full-text search for the blog application.
+#
+# Text is split into terms by tokenize(). The inverted index is kept in the
+# datastore: one SearchPosting per term and document, holding how often the
+# term occurs there, a SearchTerm per term with the number of documents it
+# occurs in, a SearchDoc per document with the terms it was indexed under,
+# and one SearchStats entity with the totals BM25 needs.
+#
+# update() applies a batch of added, changed and removed documents. It does
+# not use transactions, so calls must not run at the same time; the
+# application runs them from a task queue that runs one task at a time. Any
+# drift left by a failed batch is fixed by indexing everything again.
+#
+# Queries are ranked with BM25. Postings are stored with an impact, the term's
+# BM25 weight in that document at the time it was indexed, so each term's best
+# documents can be read from an index without reading every posting for it.
+#
+
+import math
+import re
+import unicodedata
+
+from google.appengine.ext import db
+
+# BM25 parameters.
+K1 = 1.2
+B = 0.75
+
+# Terms shorter or longer than this are not indexed.
+MIN_TERM = 2
+MAX_TERM = 40
+
+STOPWORDS = frozenset("""
+    a an and are as at be but by for from had has have he her his i if in into
+    is it its me my no not of on or our she so that the their them then there
+    these they this to too was we were what when which who will with you your
+    """.split())
+
+# Number of postings read for each query term, at least. More are read for
+# later pages.
+CANDIDATES = 200
+
+
+# Return the terms of text, in order: lowercased, accents removed, split on
+# anything that is not a letter or digit, without stopwords.
+def tokenize(text):
+    if not isinstance(text, type(u'')):
+        text = text.decode('utf-8', 'replace')
+    text = unicodedata.normalize('NFKD', text.lower())
+    text = u''.join(c for c in text if not unicodedata.combining(c))
+    return [t for t in re.findall(r'\w+', text, re.UNICODE)
+            if MIN_TERM <= len(t) <= MAX_TERM and t not in STOPWORDS]
+
+
+# Number of documents that contain a term. Key name is the term.
+class SearchTerm(db.Model):
+    df = db.IntegerProperty(default = 0, indexed = False)
+
+
+# One term in one document. Key name is "<term> <doc id>". Queried by term in
+# order of impact.
+class SearchPosting(db.Model):
+    term = db.StringProperty(required = True)
+    doc_id = db.IntegerProperty(required = True, indexed = False)
+    tf = db.IntegerProperty(required = True, indexed = False)
+    length = db.IntegerProperty(required = True, indexed = False)
+    impact = db.FloatProperty(required = True)
+
+
+# The terms a document is indexed under, so they can be removed when it
+# changes. Key name is the document id.
+class SearchDoc(db.Model):
+    terms = db.StringListProperty(indexed = False)
+    length = db.IntegerProperty(default = 0, indexed = False)
+
+
+# Number of documents indexed and their total length in terms.
+class SearchStats(db.Model):
+    docs = db.IntegerProperty(default = 0, indexed = False)
+    length = db.IntegerProperty(default = 0, indexed = False)
+
+STATS_KEY = db.Key.from_path('SearchStats', 'stats')
+
+
+def posting_key(term, doc_id):
+    return db.Key.from_path('SearchPosting', u"%s %d" % (term, doc_id))
+
+def term_key(term):
+    return db.Key.from_path('SearchTerm', term)
+
+def doc_key(doc_id):
+    return db.Key.from_path('SearchDoc', str(doc_id))
+
+
+# BM25 weight of a term occurring tf times in a document of the given length.
+def weight(tf, length, average, idf=1.0):
+    return idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * length /
+                                             max(average, 1.0)))
+
+def idf(df, docs):
+    return math.log(1 + (docs - df + 0.5) / (df + 0.5))
+
+
+# Apply changes to the index. docs maps document ids to their new text, or
+# to None for documents that have been deleted.
+def update(docs):
+    ids = list(docs)
+    found = db.get([STATS_KEY] + [doc_key(i) for i in ids])
+    stats = found[0] or SearchStats(key=STATS_KEY)
+    old = dict(zip(ids, found[1:]))
+
+    counts = {}
+    for doc_id in ids:
+        counts[doc_id] = {}
+        for term in tokenize(docs[doc_id] or ""):
+            counts[doc_id][term] = counts[doc_id].get(term, 0) + 1
+
+    # Change in document frequency of each term touched.
+    df = {}
+    for doc_id in ids:
+        before = set(old[doc_id].terms) if old[doc_id] else set()
+        after = set(counts[doc_id]) if docs[doc_id] is not None else set()
+        for term in after - before:
+            df[term] = df.get(term, 0) + 1
+        for term in before - after:
+            df[term] = df.get(term, 0) - 1
+        if old[doc_id]:
+            stats.docs -= 1
+            stats.length -= old[doc_id].length
+        if docs[doc_id] is not None:
+            stats.docs += 1
+            stats.length += sum(counts[doc_id].values())
+
+    average = float(stats.length) / stats.docs if stats.docs else 1.0
+    put = []
+    delete = []
+    for doc_id in ids:
+        if old[doc_id]:
+            delete.extend(posting_key(t, doc_id) for t in old[doc_id].terms
+                          if t not in counts[doc_id] or docs[doc_id] is None)
+        if docs[doc_id] is None:
+            if old[doc_id]:
+                delete.append(old[doc_id].key())
+            continue
+        length = sum(counts[doc_id].values())
+        for term, tf in counts[doc_id].items():
+            put.append(SearchPosting(key=posting_key(term, doc_id), term=term,
+                                     doc_id=doc_id, tf=tf, length=length,
+                                     impact=weight(tf, length, average)))
+        put.append(SearchDoc(key=doc_key(doc_id), terms=list(counts[doc_id]),
+                             length=length))
+
+    terms = [t for t in df if df[t]]
+    for term, entity in zip(terms, db.get([term_key(t) for t in terms])):
+        entity = entity or SearchTerm(key=term_key(term))
+        entity.df = max(0, entity.df + df[term])
+        if entity.df:
+            put.append(entity)
+        else:
+            delete.append(entity.key())
+    put.append(stats)
+    db.put(put)
+    db.delete(delete)
+
+
+# Results of a query: the (document id, score) pairs for one page, best
+# first, and whether there is a next page.
+class Results(object):
+    def __init__(self, hits, more):
+        self.hits = hits
+        self.more = more
+
+
+# Run a query and return a page of Results. page counts from 0.
+def search(query, page=0, size=10):
+    terms = list(set(tokenize(query)))
+    if not terms:
+        return Results([], False)
+    found = db.get([STATS_KEY] + [term_key(t) for t in terms])
+    stats = found[0]
+    if stats is None or not stats.docs:
+        return Results([], False)
+    average = float(stats.length) / stats.docs
+    idfs = dict((t, idf(e.df, stats.docs))
+                for t, e in zip(terms, found[1:]) if e is not None)
+    terms = [t for t in terms if t in idfs]
+
+    # Start reading the highest impact postings of every term at once.
+    depth = max(CANDIDATES, (page + 1) * size * 2)
+    runs = [(t, SearchPosting.all().filter('term =', t).order('-impact')
+             .run(limit=depth, batch_size=depth)) for t in terms]
+    postings = {}
+    for term, run in runs:
+        for p in run:
+            postings[(term, p.doc_id)] = p
+
+    # A candidate may contain a term without being among its best documents;
+    # get those postings by key to score every candidate fully.
+    candidates = set(doc_id for _, doc_id in postings)
+    missing = [(t, d) for t in terms for d in candidates
+               if (t, d) not in postings]
+    for (term, doc_id), p in zip(missing, db.get(
+            [posting_key(t, d) for t, d in missing])):
+        if p is not None:
+            postings[(term, doc_id)] = p
+
+    scores = {}
+    for (term, doc_id), p in postings.items():
+        scores[doc_id] = scores.get(doc_id, 0.0) + weight(
+            p.tf, p.length, average, idfs[term])
+    ranked = sorted(scores.items(), key=lambda hit: (-hit[1], hit[0]))
+    start = page * size
+    return Results(ranked[start:start + size], len(ranked) > start + size)
@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+#
+# Cookie signing for the blog application.
+#
+# Signed values look like "<value>|<key id>|<signature>", where the signature
+# is HMAC-SHA256 of the key id and value under the secret with that id. The
+# keyring holds one active key, used to sign, and any number of retired keys
+# that are still accepted, so the secret can be rotated without invalidating
+# every cookie already handed out.
+#
+
+import collections
+import hashlib
+import hmac
+
+from passwords import compare, encode
+
+
+class Keyring(object):
+    # keys is a list of (key id, secret) pairs, the active key first.
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError("a keyring needs at least one key")
+        self.active = keys[0][0]
+        self.secrets = collections.OrderedDict(keys)
+
+    def signature(self, key_id, value):
+        return hmac.new(self.secrets[key_id],
+                        encode("%s|%s" % (key_id, value)),
+                        hashlib.sha256).hexdigest()
+
+    def sign(self, value):
+        return "%s|%s|%s" % (value, self.active,
+                             self.signature(self.active, value))
+
+    # Return the value of a signed string, or None if it is malformed, signed
+    # with an unknown key or has been tampered with.
+    def verify(self, signed):
+        if not signed:
+            return None
+        parts = signed.rsplit('|', 2)
+        if len(parts) != 3 or parts[1] not in self.secrets:
+            return None
+        value, key_id, signature = parts
+        try:
+            signature = str(signature)
+        except UnicodeError:
+            return None
+        if compare(self.signature(key_id, value), signature):
+            return value
+        return None
@@ -18,9 +18,16 @@ import webapp2
 import os
 import jinja2
 
+from google.appengine.api import memcache
+
 
 template_dir = os.path.join(os.path.dirname(__file__), 'templates')
-jinja_env = jinja2.Environment(loader = jinja2.FileSystemLoader(template_dir), autoescape=True)
+# Template bytecode goes to memcache. It is only a shortcut past compiling on
+# a new instance, since memcache can drop it at any time.
+jinja_env = jinja2.Environment(
+    loader = jinja2.FileSystemLoader(template_dir), autoescape=True,
+    bytecode_cache = jinja2.MemcachedBytecodeCache(
+        memcache.Client(), prefix='jinja2/bytecode/'))
 
 
 form_html = """
@@ -86,7 +93,15 @@ class FizzBuzzHandler(Handler):
         # self.write(output)
 
 
+# /_ah/warmup: compile the templates before the first real request.
+class WarmupHandler(webapp2.RequestHandler):
+    def get(self):
+        for name in jinja_env.list_templates():
+            jinja_env.get_template(name)
+
+
 app = webapp2.WSGIApplication([
     ('/', MainPage),
-    ('/fizzbuzz', FizzBuzzHandler)
+    ('/fizzbuzz', FizzBuzzHandler),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)